@@ -0,0 +1,125 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from itertools import zip_longest
+import openpyxl
+import QB_Invoice_Import_Generator as generator
+from ErrorLogging import configure_logging
+
+#Generator modes checked against the reference implementation (the in memory ReportGenerator). Add new fast paths here.
+#Every mode sums its totals like generate_csv, so they must match it exactly (the default --tolerance 0).
+REFERENCE_MODE = 'in-memory'
+MODES = {
+    'in-memory': {},
+    'streaming': {'streaming': True},
+    'streaming-small-chunks': {'streaming': True, 'chunksize': 997}, #odd size so chunks never line up with the 5000 row sheets
+    'incremental': {'incremental': True}, #one drop with no saved state, so the whole month
+}
+MAX_LISTED_DIFFERENCES = 20
+
+def read_workbook(path):
+    """{sheet name: list of row tuples} with the cell values as stored."""
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return {sheet.title: list(sheet.iter_rows(values_only=True)) for sheet in workbook.worksheets}
+    finally:
+        workbook.close()
+
+def same_value(expected, actual, tolerance=0.0):
+    """
+    Cells match if they are equal and of the same type. Numbers may differ by tolerance (0 means exactly equal).
+    xlsx only has one number type (openpyxl reads whole numbers back as int), so 2994 and 2994.0 are the same number.
+    """
+    numbers = (int, float)
+    if isinstance(expected, numbers) and isinstance(actual, numbers) and not isinstance(expected, bool) and not isinstance(actual, bool):
+        return abs(expected - actual) <= tolerance
+    return type(expected) == type(actual) and expected == actual
+
+def compare_workbooks(expected_path, actual_path, tolerance=0.0):
+    """Every difference between two workbooks as (sheet, cell, expected, actual). Missing sheets and rows are differences too."""
+    expected, actual = read_workbook(expected_path), read_workbook(actual_path)
+    differences = []
+    for sheet_name in list(expected) + [name for name in actual if name not in expected]:
+        if sheet_name not in expected or sheet_name not in actual:
+            differences.append((sheet_name, '', 'sheet' if sheet_name in expected else None, 'sheet' if sheet_name in actual else None))
+            continue
+        for row_number, (expected_row, actual_row) in enumerate(zip_longest(expected[sheet_name], actual[sheet_name], fillvalue=()), start=1):
+            for column_number, (expected_value, actual_value) in enumerate(zip_longest(expected_row, actual_row), start=1):
+                if not same_value(expected_value, actual_value, tolerance):
+                    cell = openpyxl.utils.get_column_letter(column_number) + str(row_number)
+                    differences.append((sheet_name, cell, expected_value, actual_value))
+    return differences
+
+def generate(reference_path, raw_invoice_path, run_folder, mode):
+    """Generates raw_invoice_path with one of the MODES in its own run folder and returns the workbook path."""
+    for sub_folder in ['Input', 'Output', 'Archive']:
+        os.makedirs(os.path.join(run_folder, sub_folder), exist_ok=True)
+    shutil.copy(reference_path, os.path.join(run_folder, 'MasterReference.xlsx'))
+    rg = generator.ReportGenerator(raw_invoice_path=raw_invoice_path, current_path=run_folder, **MODES[mode])
+    if not rg.generate_csv(archive=False):
+        raise RuntimeError(f'{mode} failed to generate {os.path.basename(raw_invoice_path)}, see ERROR_DETAILS.csv in {run_folder}')
+    return os.path.join(rg.save_location, rg.create_output_name())
+
+def print_differences(title, differences):
+    print(f'{title}: {"identical" if not differences else f"{len(differences)} differences"}')
+    for sheet_name, cell, expected, actual in differences[:MAX_LISTED_DIFFERENCES]:
+        print(f'    {sheet_name}!{cell}: expected {expected!r}, got {actual!r}')
+    if len(differences) > MAX_LISTED_DIFFERENCES:
+        print(f'    ... {len(differences) - MAX_LISTED_DIFFERENCES} more')
+
+def check_invoice(reference_path, raw_invoice_path, modes, work_folder, golden_folder='', tolerance=0.0):
+    """Generates one raw invoice in the reference mode and every mode in modes, and diffs each against the reference (and the golden workbook, if any)."""
+    name = os.path.basename(raw_invoice_path)
+    expected_path = generate(reference_path, raw_invoice_path, os.path.join(work_folder, REFERENCE_MODE), REFERENCE_MODE)
+    identical = True
+    if golden_folder:
+        golden_path = os.path.join(golden_folder, os.path.basename(expected_path))
+        if os.path.exists(golden_path):
+            differences = compare_workbooks(golden_path, expected_path, tolerance)
+            print_differences(f'{name}: {REFERENCE_MODE} vs golden {os.path.basename(golden_path)}', differences)
+            identical = identical and not differences
+        else:
+            print(f'{name}: no golden workbook {os.path.basename(golden_path)} in {golden_folder}')
+    for mode in modes:
+        actual_path = generate(reference_path, raw_invoice_path, os.path.join(work_folder, mode), mode)
+        differences = compare_workbooks(expected_path, actual_path, tolerance)
+        print_differences(f'{name}: {mode} vs {REFERENCE_MODE}', differences)
+        identical = identical and not differences
+    return identical
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks that the optimized generator modes produce the same workbook, cell for cell, as the reference implementation.')
+    parser.add_argument('folder', nargs='?', help='run folder: its MasterReference.xlsx with the raw invoices in Input and Archive')
+    parser.add_argument('--synthetic', help='check a SyntheticData set of this PipelineBenchmark scale instead of a folder')
+    parser.add_argument('--modes', nargs='+', default=[mode for mode in MODES if mode != REFERENCE_MODE], help=f'modes to check (default: all of {", ".join(MODES)} except the reference)')
+    parser.add_argument('--golden', default='', help='folder of previously generated workbooks (same file names) to check the reference output against')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='allowed absolute difference between numbers (default 0: identical)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated workbooks and print where they are')
+    args = parser.parse_args(argv)
+    unknown = [mode for mode in args.modes if mode not in MODES]
+    if unknown or not (args.folder or args.synthetic):
+        parser.error(f'unknown mode(s) {", ".join(unknown)}' if unknown else 'give a folder or --synthetic')
+    configure_logging(interactive=False)
+    work_folder = tempfile.mkdtemp(prefix='equivalence_')
+    try:
+        if args.synthetic:
+            from SyntheticData import make_dataset
+            from PipelineBenchmark import SCALES
+            data_folder = os.path.join(work_folder, 'data')
+            raw_invoices = [make_dataset(data_folder, *SCALES[args.synthetic])]
+        else:
+            data_folder = os.path.abspath(args.folder)
+            raw_invoices = generator.find_raw_invoices(os.path.join(data_folder, 'Input')) + generator.find_archived_raw_invoices(data_folder)
+        reference_path = os.path.join(data_folder, 'MasterReference.xlsx')
+        results = [check_invoice(reference_path, raw_invoice, args.modes, os.path.join(work_folder, str(i)), args.golden, args.tolerance) for i, raw_invoice in enumerate(raw_invoices)]
+    finally:
+        if args.keep:
+            print(f'Workbooks kept in {work_folder}')
+        else:
+            shutil.rmtree(work_folder, ignore_errors=True)
+    return 0 if all(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,59 @@
-import tkinter as tk
 import pandas as pd 
 import os
+import sys
+import json
+import logging
+from datetime import datetime
 from PathManager import locationManager as lm
 
+#Exit codes of the command line entry point (InvoiceCLI). 2 is what argparse uses for bad arguments.
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_INVOICE = 3
+EXIT_ERROR = 4
+
+log = logging.getLogger('invoice_generator')
+_interactive = True
+
+def set_interactive(interactive):
+    """With interactive=False errors are only logged, so a run never blocks on a popup (batch servers, scheduled runs)."""
+    global _interactive
+    _interactive = interactive
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message, plus anything passed through extra={'fields': {...}}."""
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='seconds'), 'level': record.levelname, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging(log_path='', interactive=True, verbose=False):
+    """Logs to stderr and, if log_path is given, appends JSON lines to it."""
+    set_interactive(interactive)
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    log.handlers.clear()
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    log.addHandler(console)
+    if log_path:
+        log_file = logging.FileHandler(log_path, encoding='utf-8')
+        log_file.setFormatter(JsonLogFormatter())
+        log.addHandler(log_file)
+    return log
+
 def error_popup(msg):
-    """Super simple pop-up to indicate an error has occured."""
-    popup = tk.Tk()
+    """Logs the error and, unless running non interactively, shows a super simple pop-up for it."""
+    log.error(msg)
+    if not _interactive:
+        return
+    try:
+        import tkinter as tk #only loaded when a popup is actually needed
+        popup = tk.Tk()
+    except Exception: #no display, the error is in the log already
+        return
     popup.wm_title("!")
     label = tk.Label(popup, text=msg)
     label.pack(side="top", fill="x", pady=10)
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import traceback
+from datetime import datetime
+from multiprocessing import freeze_support
+
+#Only the standard library is imported up front so --help and argument errors come back instantly.
+#pandas, the generator and tkinter (for popups) are loaded once the arguments are known to be good.
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected YYYY-MM, got {value}')
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generates the QuickBooks invoice import from the raw invoices in <path>/Input.',
+                                     epilog='Exit codes: 0 done, 1 checks or generation failed, 2 bad arguments, 3 no invoice found, 4 unexpected error.')
+    parser.add_argument('path', nargs='?', default='', help='folder holding MasterReference.xlsx, Input, Output and Archive (default: next to the program)')
+    parser.add_argument('--month', type=parse_month, help='only generate the raw invoice for this month (YYYY-MM); only that invoice is archived')
+    parser.add_argument('--format', dest='output_format', choices=['xlsx', 'csv', 'both'], default='xlsx', help='output the workbook, csv files or both (default: xlsx)')
+    parser.add_argument('--streaming', action='store_true', help='read the raw invoice in chunks to keep memory flat on very large months')
+    parser.add_argument('--incremental', action='store_true', help='treat the raw invoices as partial drops and update the month to date output (state kept in <path>/State)')
+    parser.add_argument('--upsert', action='store_true', help='update customers already in the Master Reference from the customer files (default: only add new ones)')
+    parser.add_argument('--workers', type=int, help='processes used when several months are generated at once (worker threads with --watch)')
+    parser.add_argument('--no-archive', action='store_true', help='leave the input files in Input')
+    parser.add_argument('--headless', action='store_true', help='never open popups, errors only go to the log and the exit code')
+    parser.add_argument('--log-file', help='JSON lines run log (default: <path>/RUN_LOG.jsonl)')
+    parser.add_argument('--verbose', action='store_true', help='also log debug messages')
+    parser.add_argument('--trace-memory', action='store_true', help='record the Python heap peak of every stage in the run report (slower)')
+    parser.add_argument('--profile', action='store_true', help='also dump a cProfile of the whole run to Output/RUN_PROFILE.prof')
+    watch = parser.add_argument_group('watch mode')
+    watch.add_argument('--watch', action='store_true', help='keep running and process every raw invoice and customer file dropped in Input (implies --headless; stop with Ctrl+C)')
+    watch.add_argument('--poll', type=float, default=2.0, help='seconds between looks at Input (default: 2)')
+    watch.add_argument('--settle', type=float, default=5.0, help='seconds a file must stay unchanged before it is processed (default: 5)')
+    watch.add_argument('--queue-size', type=int, default=8, help='files queued for the workers at most (default: 8)')
+    return parser
+
+def run(argv=None):
+    """Command line entry point. Returns the process exit code."""
+    args = build_parser().parse_args(argv)
+    path = os.path.abspath(args.path) if args.path else os.path.dirname(sys.executable)
+    from ErrorLogging import configure_logging, EXIT_ERROR
+    log = configure_logging(args.log_file or os.path.join(path, 'RUN_LOG.jsonl'), interactive=not (args.headless or args.watch), verbose=args.verbose)
+    if args.watch:
+        return watch(path, args, log)
+    start = time.perf_counter()
+    log.info('Running', extra={'fields': {'path': path, 'month': args.month, 'format': args.output_format, 'streaming': args.streaming, 'incremental': args.incremental, 'upsert': args.upsert}})
+    try:
+        import QB_Invoice_Import_Generator as generator
+        from RunReport import RunReport
+        run_args = (path, args.streaming, args.output_format, args.month, not args.no_archive, args.workers, RunReport(args.trace_memory), args.incremental, args.upsert)
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                exit_code = profiler.runcall(generator.main, *run_args)
+            finally:
+                profile_path = os.path.join(path, 'Output', 'RUN_PROFILE.prof')
+                profiler.dump_stats(profile_path)
+                log.info('Profile written', extra={'fields': {'profile': profile_path}})
+        else:
+            exit_code = generator.main(*run_args)
+    except Exception:
+        log.exception('Unexpected error')
+        with open(os.path.join(path, 'TRACEBACK.txt'), 'w') as f:
+            f.write(f'{traceback.format_exc()}')
+        exit_code = EXIT_ERROR
+    log.info('Finished', extra={'fields': {'exit_code': exit_code, 'seconds': round(time.perf_counter() - start, 3)}})
+    return exit_code
+
+def watch(path, args, log):
+    """Runs the InvoiceWatcher until Ctrl+C or SIGTERM. --workers is its number of worker threads."""
+    from ErrorLogging import EXIT_OK, EXIT_ERROR
+    from InvoiceWatcher import InvoiceWatcher
+    watcher = InvoiceWatcher(path, args.workers or 1, args.streaming, args.output_format, args.incremental, args.poll, args.settle, args.queue_size, args.upsert)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        log.exception('Unexpected error')
+        return EXIT_ERROR
+    return EXIT_OK
+
+if __name__ == '__main__':
+    freeze_support()
+    sys.exit(run())
@@ -0,0 +1,269 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+from itertools import groupby
+import pandas as pd
+
+HISTORY_DB = 'InvoiceHistory.sqlite'
+#Batch workers store their months at the same time, so a writer may have to wait for another month's transaction
+HISTORY_TIMEOUT = 600
+
+#table: {sheet column: table column}. Every table also has the month (YYYY-MM) the rows were invoiced in.
+LENS_COLUMNS = {'Pivotal Account': 'pivotal_account', 'Dropship': 'dropship', 'DropShipNo': 'drop_ship_no', 'OrderID': 'order_id',
+                'ShipDate': 'ship_date', 'ItemName': 'item_name', 'UPC': 'upc', 'Category': 'category', 'ShipQty': 'ship_qty',
+                'UnitPrice': 'unit_price', 'ShipAmount': 'ship_amount', 'NewUnit$': 'new_unit_price', 'NewShipAmount': 'new_ship_amount'}
+TABLES = {
+    'lens_rows': LENS_COLUMNS,
+    'return_rows': LENS_COLUMNS,
+    'shipping_rows': {'Pivotal Account': 'pivotal_account', 'Dropship': 'dropship', 'OrderID': 'order_id', 'ShipDate': 'ship_date',
+                      'ShipVia': 'ship_via', 'Freight': 'freight'},
+    'tax_rows': {'Pivotal Account': 'pivotal_account', 'Dropship': 'dropship', 'DropShipNo': 'drop_ship_no', 'OrderID': 'order_id',
+                 'ShipDate': 'ship_date', 'NewShipAmount': 'tax'},
+    'customer_totals': {'Pivotal #': 'pivotal_account', 'DropShipNo': 'drop_ship_no', 'Freight': 'freight', 'ShipAmount': 'ship_amount',
+                        'NewShipAmount': 'new_ship_amount', 'Discount': 'discount', 'Total Charged': 'total_charged'},
+}
+TEXT_COLUMNS = ['pivotal_account', 'dropship', 'drop_ship_no', 'order_id', 'ship_date', 'item_name', 'upc', 'category', 'ship_via']
+INTEGER_COLUMNS = ['ship_qty']
+#months column: row of the Summary Overview sheet it comes from
+OVERVIEW_ROWS = {'retail_invoiced': 0, 'shipping': 1, 'discount': 2, 'total_invoiced': 3, 'pivotal_invoiced': 7, 'somo_disc': 8,
+                 'tax': 10, 'total_cost': 11, 'return_credits': 12, 'net_profit': 16}
+INDEXES = {
+    'lens_rows': [['month'], ['pivotal_account', 'month'], ['upc', 'month']],
+    'return_rows': [['month'], ['pivotal_account', 'month'], ['upc', 'month']],
+    'shipping_rows': [['month']],
+    'tax_rows': [['month']],
+    'customer_totals': [['month'], ['pivotal_account', 'month']],
+}
+
+def column_type(column):
+    return 'TEXT' if column in TEXT_COLUMNS else 'INTEGER' if column in INTEGER_COLUMNS else 'REAL'
+
+def parse_month(value):
+    """'YYYY-MM' as stored in the history, for a date or a 'YYYY-MM' string. None stays None (no limit)."""
+    if value is None or isinstance(value, str):
+        return value and datetime.strptime(value, '%Y-%m').strftime('%Y-%m')
+    return f'{value:%Y-%m}'
+
+def month_range(start=None, end=None):
+    """SQL condition and parameters for start <= month <= end (either may be None)."""
+    conditions, parameters = ['1=1'], []
+    if start is not None:
+        conditions.append('month >= ?')
+        parameters.append(parse_month(start))
+    if end is not None:
+        conditions.append('month <= ?')
+        parameters.append(parse_month(end))
+    return ' AND '.join(conditions), parameters
+
+def column_values(series):
+    """Plain Python values sqlite can store. float32 amounts (ShipAmount) are stored as the cents they were read as."""
+    if series.dtype == 'float32':
+        series = series.astype('float64').round(2)
+    return series.astype(object).where(series.notna(), None).tolist()
+
+class InvoiceHistory:
+    def __init__(self, current_path, db_name=HISTORY_DB):
+        """
+        Every generated month's sheet rows and totals, in an indexed SQLite database next to the Master Reference.
+        Each supplier has its own database (db_name, see SupplierProfile.history_db), so their months don't replace each other.
+        ReportGenerator.generate_csv stores each month as it's generated (replacing the month if it's generated again),
+        backfill() loads the raw invoices already in Archive. The rollup queries return DataFrames.
+        """
+        self.path = os.path.join(current_path, db_name)
+        self.connection = sqlite3.connect(self.path, timeout=HISTORY_TIMEOUT)
+        self.create_tables()
+
+    def create_tables(self):
+        for table, columns in TABLES.items():
+            definitions = ', '.join(f'{column} {column_type(column)}' for column in columns.values())
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (month TEXT NOT NULL, {definitions})')
+            for index_columns in INDEXES[table]:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_{"_".join(index_columns)} ON {table} ({", ".join(index_columns)})')
+        overview = ', '.join(f'{column} REAL' for column in OVERVIEW_ROWS)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS months (month TEXT PRIMARY KEY, raw_invoices TEXT, stored_at TEXT, {overview})')
+        self.connection.commit()
+
+    def begin_month(self, month):
+        """Starts replacing a month: its old rows are deleted, but only for good once store_month commits. Opens the write transaction."""
+        month = parse_month(month)
+        for table in list(TABLES) + ['months']:
+            self.connection.execute(f'DELETE FROM {table} WHERE month = ?', (month,))
+
+    def add_rows(self, table, month, sheet, target=None):
+        """Adds a sheet's rows to one of the TABLES (or to target, a table with the same columns)."""
+        if sheet is None or sheet.empty:
+            return
+        columns = TABLES[table]
+        values = [column_values(sheet[column]) for column in columns]
+        placeholders = ', '.join('?' * (len(columns)+1))
+        self.connection.executemany(f'INSERT INTO {target or table} (month, {", ".join(columns.values())}) VALUES ({placeholders})',
+                                    zip([parse_month(month)]*sheet.shape[0], *values))
+
+    def stage_rows(self, table, month, sheet):
+        """
+        Keeps a sheet's rows for one of the TABLES in a temporary table of this connection until store_month moves them in.
+        For months streamed chunk by chunk: the temporary tables aren't in the database file, so staging doesn't hold its
+        write lock, and other workers can store their months while this one is still being generated.
+        """
+        self.create_staging_table(table)
+        self.add_rows(table, month, sheet, f'temp.staged_{table}')
+        self.connection.commit()
+
+    def create_staging_table(self, table):
+        self.connection.execute(f'CREATE TEMP TABLE IF NOT EXISTS staged_{table} AS SELECT * FROM main.{table} WHERE 0')
+
+    def store_month(self, rg, raw_invoices, staged=False):
+        """
+        Replaces rg's month (a ReportGenerator whose sheets are built) with its sheets and commits, in one short write transaction.
+        staged means the Lens Import, Returns, Shipping and Tax rows were staged chunk by chunk with stage_rows (generate_csv_streaming).
+        """
+        month = parse_month(rg.now)
+        sheets = {'lens_rows': rg.LensImport, 'return_rows': rg.LensReturnsCredits, 'shipping_rows': rg.ShippingImport, 'tax_rows': rg.TaxSheet}
+        if staged:
+            for table in sheets:
+                self.create_staging_table(table)
+        self.begin_month(month)
+        for table, sheet in sheets.items():
+            if staged:
+                self.connection.execute(f'INSERT INTO {table} SELECT * FROM temp.staged_{table}')
+                self.connection.execute(f'DELETE FROM temp.staged_{table}')
+            else:
+                self.add_rows(table, month, sheet)
+        #Summary Details also lists the customers who didn't purchase, without totals
+        self.add_rows('customer_totals', month, rg.SummarySheet[rg.SummarySheet['ShipAmount'].notna()])
+        overview = [float(rg.SummaryOverviewSheet['Value'].iloc[row]) for row in OVERVIEW_ROWS.values()]
+        self.connection.execute(f'INSERT INTO months VALUES ({", ".join("?" * (len(OVERVIEW_ROWS)+3))})',
+                                [month, ', '.join(os.path.basename(raw_invoice) for raw_invoice in raw_invoices), datetime.now().isoformat(timespec='seconds')] + overview)
+        self.connection.commit()
+
+    def rollback(self):
+        """Undoes what isn't committed yet and drops any staged rows."""
+        self.connection.rollback()
+        for table in TABLES:
+            self.connection.execute(f'DROP TABLE IF EXISTS temp.staged_{table}')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, sql, parameters=()):
+        return pd.read_sql_query(sql, self.connection, params=list(parameters))
+
+    def customer_rollup(self, customer=None, start=None, end=None, by_month=False):
+        """Totals per Pivotal Account (one customer, or all) between two months, per month with by_month."""
+        condition, parameters = month_range(start, end)
+        if customer is not None:
+            condition += ' AND pivotal_account = ?'
+            parameters.append(customer)
+        group = 'pivotal_account, month' if by_month else 'pivotal_account'
+        return self.query(f'''SELECT {group}, COUNT(*) AS months_invoiced, SUM(ship_amount) AS ship_amount, SUM(new_ship_amount) AS new_ship_amount,
+                              SUM(freight) AS freight, SUM(discount) AS discount, SUM(total_charged) AS total_charged
+                              FROM customer_totals WHERE {condition} GROUP BY {group} ORDER BY {group}''', parameters)
+
+    def upc_rollup(self, upc=None, start=None, end=None, by_month=False):
+        """Quantities and amounts sold and returned per UPC (one, or all) between two months, per month with by_month."""
+        condition, parameters = month_range(start, end)
+        if upc is not None:
+            condition += ' AND upc = ?'
+            parameters.append(str(upc).zfill(10))
+        group = 'upc, month' if by_month else 'upc'
+        columns = 'upc, month, category, ship_qty, ship_amount, new_ship_amount'
+        return self.query(f'''SELECT {group}, MAX(category) AS category,
+                              SUM(CASE WHEN ship_qty >= 0 THEN ship_qty ELSE 0 END) AS sold_qty, SUM(CASE WHEN ship_qty < 0 THEN -ship_qty ELSE 0 END) AS returned_qty,
+                              SUM(ship_amount) AS ship_amount, SUM(new_ship_amount) AS new_ship_amount
+                              FROM (SELECT {columns} FROM lens_rows WHERE {condition} UNION ALL SELECT {columns} FROM return_rows WHERE {condition})
+                              GROUP BY {group} ORDER BY {group}''', parameters*2)
+
+    def month_rollup(self, start=None, end=None):
+        """The Summary Overview figures of every stored month between two months."""
+        condition, parameters = month_range(start, end)
+        return self.query(f'SELECT * FROM months WHERE {condition} ORDER BY month', parameters)
+
+def store_history(rg, raw_invoices):
+    """Stores the month rg just generated (see InvoiceHistory.store_month)."""
+    history = InvoiceHistory(rg.current_location, rg.profile.history_db)
+    try:
+        history.store_month(rg, raw_invoices)
+    finally:
+        history.close()
+
+def backfill(current_path, reference=None, profile=None):
+    """
+    Loads every raw invoice of a supplier (a SupplierProfile, default: DEFAULT_PROFILE) in Archive into its history, one month at a time. A month sent in several drops is
+    built like an incremental run, so rows repeated across its files are only counted once. Returns the months stored.
+    Totals are summed in cents like every generator mode sums them (see InvoiceTotals).
+    """
+    import QB_Invoice_Import_Generator as generator
+    from ReferenceContext import ReferenceContext
+    from InvoiceState import InvoiceState
+    from SupplierProfile import DEFAULT_PROFILE
+    profile = profile or DEFAULT_PROFILE
+    if reference is None:
+        reference = ReferenceContext(os.path.join(current_path, 'MasterReference.xlsx'))
+    raw_invoices = sorted(generator.find_archived_raw_invoices(current_path, [profile]), key=lambda raw_invoice: (generator.invoice_month(raw_invoice), os.path.getmtime(raw_invoice)))
+    history = InvoiceHistory(current_path, profile.history_db)
+    stored = []
+    try:
+        for month, drops in groupby(raw_invoices, key=generator.invoice_month):
+            drops = list(drops)
+            rg = generator.ReportGenerator(raw_invoice_path=drops[-1], reference=reference, current_path=current_path, incremental=True, profile=profile)
+            #No workbook is written, so no invoice numbers are reserved
+            rg.invoice_sequence = None
+            if rg.process_drops(InvoiceState(month), drops):
+                history.store_month(rg, drops)
+                stored.append(parse_month(month))
+    finally:
+        history.close()
+    return stored
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Queries the invoice history (InvoiceHistory.sqlite) of a run folder, or backfills it from Archive.')
+    parser.add_argument('path', help='folder holding MasterReference.xlsx, Archive and the history database')
+    parser.add_argument('rollup', choices=['customer', 'upc', 'month', 'backfill'], help='totals per customer, per UPC, per month, or load Archive into the history')
+    parser.add_argument('key', nargs='?', help='Pivotal Account (customer) or UPC (upc) to limit the rollup to')
+    parser.add_argument('--from', dest='start', help='first month, YYYY-MM')
+    parser.add_argument('--to', dest='end', help='last month, YYYY-MM')
+    parser.add_argument('--by-month', action='store_true', help='one row per month instead of one total (customer, upc)')
+    parser.add_argument('--csv', help='write the result to this csv file instead of printing it')
+    parser.add_argument('--supplier', help='name of the supplier profile whose history to use (default: the first in SupplierProfiles.json, or H00241)')
+    args = parser.parse_args(argv)
+    path = os.path.abspath(args.path)
+    from SupplierProfile import load_profiles
+    profiles = {profile.name: profile for profile in load_profiles(path)}
+    if args.supplier is not None and args.supplier not in profiles:
+        parser.error(f'unknown supplier {args.supplier}, the profiles are {", ".join(profiles)}')
+    profile = profiles[args.supplier] if args.supplier is not None else next(iter(profiles.values()))
+    if args.rollup == 'backfill':
+        from ErrorLogging import configure_logging
+        configure_logging(interactive=False)
+        stored = backfill(path, profile=profile)
+        print(f'Stored {len(stored)} month(s): {", ".join(stored)}')
+        return 0
+    try:
+        parse_month(args.start), parse_month(args.end)
+    except ValueError:
+        parser.error('--from and --to are YYYY-MM')
+    history = InvoiceHistory(path, profile.history_db)
+    try:
+        start = time.perf_counter()
+        if args.rollup == 'customer':
+            result = history.customer_rollup(args.key, args.start, args.end, args.by_month)
+        elif args.rollup == 'upc':
+            result = history.upc_rollup(args.key, args.start, args.end, args.by_month)
+        else:
+            result = history.month_rollup(args.start, args.end)
+        seconds = time.perf_counter() - start
+    finally:
+        history.close()
+    if args.csv:
+        result.to_csv(args.csv, index=False)
+    else:
+        print(result.to_string(index=False))
+    print(f'{result.shape[0]} row(s) in {seconds*1000:.1f} ms', file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
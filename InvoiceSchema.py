@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+#The customer key: DropShipNo in the raw invoice and every sheet, SuffixNum in the CustomerList. Nullable, since a raw
+#invoice row can be missing its DropShipNo. Keys are compared as this type everywhere, never as strings or floats.
+CUSTOMER_KEY_DTYPE = 'Int32'
+
+#Explicit dtypes for reading raw invoices, so pandas doesn't fall back to object columns. ShipAmount is float32 like the Lens Import;
+#the other amounts stay float64 so the rounded money values written to the workbook don't change.
+#The repeated text columns (ShipDate, ShipVia, ItemName) are categoricals: one small code per row instead of a Python string.
+RAW_INVOICE_DTYPES = {'DropShipNo': CUSTOMER_KEY_DTYPE, 'ShipDate': 'category', 'ShipVia': 'category', 'ItemName': 'category',
+                      'ShipAmount': 'float32', 'UnitPrice': 'float64', 'Freight': 'float64', 'Tax': 'float64', 'TotalAmount': 'float64'}
+
+#Master Reference columns that are only read, never edited in place (the CustomerList is, by MasterReferenceUpdater)
+PRICE_SHEET_DTYPES = {'Lens': 'category'}
+
+def raw_invoice_dtypes(raw_invoice_path):
+    """RAW_INVOICE_DTYPES for the columns this raw invoice has."""
+    header = pd.read_csv(raw_invoice_path, nrows=0).columns
+    return {column: dtype for column, dtype in RAW_INVOICE_DTYPES.items() if column in header}
+
+def apply_dtypes(frame, dtypes):
+    """frame with the dtypes of the columns it has. Columns already of that dtype aren't copied."""
+    changes = {column: dtype for column, dtype in dtypes.items() if column in frame.columns and frame[column].dtype != dtype}
+    return frame.astype(changes) if changes else frame
+
+def customer_keys(values):
+    """Any DropShipNo / SuffixNum values (int, float or str) as customer keys. Values that aren't numbers become <NA>."""
+    if not isinstance(values, pd.Series):
+        #An empty list has nothing to infer a dtype from (pandas warns), so it gets the key dtype
+        values = pd.Series(values, dtype=None if len(values) else CUSTOMER_KEY_DTYPE)
+    if values.dtype == CUSTOMER_KEY_DTYPE:
+        return values
+    return np.trunc(pd.to_numeric(values, errors='coerce').astype('float64')).astype(CUSTOMER_KEY_DTYPE)
+
+def constant_column(value, length):
+    """
+    A column holding value on every row. Text becomes a one category Categorical (one byte per row),
+    anything else a numpy array, instead of a list of length Python references.
+    """
+    if isinstance(value, str):
+        return pd.Categorical.from_codes(np.zeros(length, dtype='int8'), categories=[value])
+    return np.full(length, value)
@@ -0,0 +1,56 @@
+import os
+import sqlite3
+from calendar import monthrange
+
+#Next free Discount Import invoice number of every month. One database per run folder, shared by every supplier,
+#since the numbers don't say which supplier they're for. Kept with the other run state in State/.
+SEQUENCE_DB = os.path.join('State', 'InvoiceSequence.sqlite')
+#Batch workers and watcher threads can allocate at the same time; the transaction is tiny, so a wait is short
+SEQUENCE_TIMEOUT = 60
+
+def invoice_number_prefix(month):
+    """'D', the month and year (MMYY) and the month's last day, e.g. D032331 for March 2023."""
+    return f'D{month:%m%y}{monthrange(month.year, month.month)[1]}'
+
+def format_invoice_numbers(month, first, count):
+    """count consecutive invoice numbers of month from first, the sequence number padded to 4 digits (D0323310001)."""
+    prefix = invoice_number_prefix(month)
+    return [f'{prefix}{number:04d}' for number in range(first, first+count)]
+
+class InvoiceSequence:
+    def __init__(self, current_path, db_name=SEQUENCE_DB):
+        """
+        Persistent invoice number sequence of every month, so a rerun, a later drop of the month or another supplier
+        never hands out a number that was already used. Numbers are reserved in blocks, one per Discount Import:
+        a single short SQLite write transaction (BEGIN IMMEDIATE) per block, which also locks out other processes meanwhile.
+        A block is reserved for good, so a run that fails after reserving it leaves a gap rather than a duplicate.
+        """
+        self.path = os.path.join(current_path, db_name)
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        #Autocommit mode, so the transaction is exactly what allocate() begins and commits
+        connection = sqlite3.connect(self.path, timeout=SEQUENCE_TIMEOUT, isolation_level=None)
+        connection.execute('CREATE TABLE IF NOT EXISTS sequences (month TEXT PRIMARY KEY, next_number INTEGER NOT NULL)')
+        return connection
+
+    def allocate(self, month, count):
+        """Reserves count numbers of month (a date, any day). Returns the first one; the first block of a month starts at 1."""
+        if count <= 0:
+            return 1
+        key = f'{month:%Y-%m}'
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT next_number FROM sequences WHERE month = ?', (key,)).fetchone()
+            first = row[0] if row else 1
+            connection.execute('INSERT OR REPLACE INTO sequences (month, next_number) VALUES (?, ?)', (key, first + count))
+            connection.execute('COMMIT')
+        finally:
+            #Closing without the COMMIT rolls the transaction back
+            connection.close()
+        return first
+
+    def invoice_numbers(self, month, count):
+        """count new invoice numbers of month, reserved as one block."""
+        return format_invoice_numbers(month, self.allocate(month, count), count)
@@ -0,0 +1,59 @@
+import os
+import pickle
+from InvoiceTotals import InvoiceTotals
+
+class InvoiceState:
+    def __init__(self, month):
+        """
+        Running state of one invoice month: the sheet rows of every raw invoice row processed so far and its per customer
+        totals, added up in cents (an InvoiceTotals) so they come out exactly as generate_csv's would.
+        The streaming generator keeps one while it reads the chunks, with its sheet rows spooled to disk. Incremental runs save it in State/, so each
+        partial drop from the supplier only has its new rows enriched and added (see ReportGenerator.generate_csv_incremental).
+        Rows are identified by OrderID/Barcode: a row whose pair was in an earlier file is skipped, repeats within one file are kept.
+        """
+        self.month = month
+        self.files = []
+        self.seen_keys = set()
+        self.pending_keys = set()
+        self.totals = InvoiceTotals()
+        self.lens = []
+        self.shipping = []
+        self.taxes = []
+        self.returns = []
+        self.all_customers = {}
+        self.kept_customers = {}
+
+    @staticmethod
+    def row_keys(raw):
+        """'OrderID|Barcode' for every raw invoice row. Barcodes read as floats (a column with blanks) lose their '.0'."""
+        barcodes = raw['Barcode'].astype(str).str.replace(r'\.0$', '', regex=True)
+        return raw['OrderID'].astype(str).str.cat(barcodes.values, sep='|')
+
+    def take_new_rows(self, raw):
+        """Drops the rows already processed from an earlier file. Their keys only count as seen once finish_file is called."""
+        keys = self.row_keys(raw)
+        is_new = ~keys.isin(self.seen_keys)
+        self.pending_keys.update(keys[is_new])
+        return raw[is_new.values]
+
+    def finish_file(self, file_name):
+        self.seen_keys.update(self.pending_keys)
+        self.pending_keys = set()
+        self.files.append(file_name)
+
+    @classmethod
+    def load(cls, path):
+        """The saved state, or None if there isn't one yet (or it was saved before its totals were kept in cents, so it's rebuilt from Archive)."""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        return state if hasattr(state, 'totals') else None
+
+    def save(self, path):
+        """Saves the state, replacing the old file only once the new one is completely written."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
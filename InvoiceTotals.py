@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+#Money is totalled in whole cents (int64). That's exact, so a total doesn't depend on how the rows were split into chunks
+#or drops: generate_csv, the streaming generator and incremental runs all come out the same to the cent.
+CENTS = 100
+AMOUNT_COLUMNS = ['ShipAmount', 'NewShipAmount']
+
+def to_cents(amounts):
+    """Money amounts (any float dtype, already rounded to the cent) as int64 cents. NaN counts as 0."""
+    return np.rint(np.nan_to_num(np.asarray(amounts, dtype='float64')) * CENTS).astype('int64')
+
+def from_cents(cents):
+    """Cents back as amounts, each the float closest to its exact value."""
+    return np.asarray(cents, dtype='int64') / CENTS
+
+def money_sum(amounts):
+    """Exact total of money amounts (NaN counts as 0)."""
+    return int(to_cents(amounts).sum()) / CENTS
+
+def sum_cents(frame, keys, columns):
+    """columns of frame in cents, summed per keys (columns of frame), keys in order of first appearance."""
+    cents = pd.DataFrame({column: to_cents(frame[column]) for column in columns}, index=frame.index)
+    return cents.groupby([frame[key] for key in keys], sort=False, observed=True).sum()
+
+def add_sums(running, sums):
+    """Adds two sum_cents results (running may be None), keys in order of first appearance."""
+    if running is None:
+        return sums
+    combined = pd.concat([running, sums])
+    return combined.groupby(level=list(range(combined.index.nlevels)), sort=False, observed=True).sum()
+
+
+class InvoiceTotals:
+    def __init__(self):
+        """
+        Per customer totals of an invoice month, added up sheet by sheet (generate_csv) or chunk by chunk (streaming, incremental drops).
+        They hold one row per Pivotal Account (and Category) in cents however many raw invoice rows went into them, so
+        the streaming generator doesn't have to keep the rows until the summaries are built.
+        """
+        self.lens = None #ShipAmount, NewShipAmount per Pivotal Account of every Lens Import row, returns included
+        self.returns = None #the same, for the returns (ShipQty < 0) only
+        self.categories = None #NewShipAmount per Pivotal Account and Category, returns included (for DiscountRules)
+        self.freight = None
+        self.tax = None
+        self.somo_disc = 0 #the Pivotal discount rows (DropShipNo 0)
+
+    def add_sheets(self, lens, shipping, taxes):
+        """Adds Lens Import rows (returns included), Shipping Import rows and Tax sheet rows."""
+        self.lens = add_sums(self.lens, sum_cents(lens, ['Pivotal Account'], AMOUNT_COLUMNS))
+        self.returns = add_sums(self.returns, sum_cents(lens[lens['ShipQty'].values < 0], ['Pivotal Account'], AMOUNT_COLUMNS))
+        self.categories = add_sums(self.categories, sum_cents(lens, ['Pivotal Account', 'Category'], ['NewShipAmount']))
+        self.freight = add_sums(self.freight, sum_cents(shipping, ['Pivotal Account'], ['Freight']))
+        self.tax = add_sums(self.tax, sum_cents(taxes, ['Pivotal Account'], ['NewShipAmount']).rename(columns={'NewShipAmount': 'Tax'}))
+
+    def add_discounts(self, amounts):
+        """Adds the TotalAmount of Pivotal discount rows."""
+        self.somo_disc += int(to_cents(amounts).sum())
+
+    def customer_totals(self, discount_import=None, returns=True):
+        """
+        ShipAmount, NewShipAmount, Freight, Discount and Tax per Pivotal Account. returns=False leaves the returns out of
+        ShipAmount and NewShipAmount. Discount is 0 until discount_import (the Discount Import sheet) is passed. Customers missing from one get 0.
+        """
+        lens = self.lens if returns else self.lens - self.returns.reindex(self.lens.index, fill_value=0)
+        discounts = sum_cents(discount_import, ['Pivotal Account No.'], ['Discount']) if discount_import is not None else pd.DataFrame(columns=['Discount'], dtype='int64')
+        combined = lens
+        for other in [self.freight, discounts, self.tax]:
+            combined = combined.join(other, how='outer')
+        return combined.fillna(0).astype('int64') / CENTS
+
+    def category_totals(self):
+        """NewShipAmount per Pivotal Account and Category."""
+        return self.categories / CENTS
+
+    def returns_total(self):
+        return int(self.returns['NewShipAmount'].sum()) / CENTS
+
+    def tax_total(self):
+        return int(self.tax['Tax'].sum()) / CENTS
+
+    def somo_disc_total(self):
+        return self.somo_disc / CENTS
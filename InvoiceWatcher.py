@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import queue
+import threading
+from collections import defaultdict
+from PathManager import locationManager as lm
+from ErrorLogging import error_popup, log
+from ReferenceContext import ReferenceContext
+from MasterReferenceUpdater import MasterReferenceUpdater, CUSTOMER_FILE_PATTERN
+from RunReport import RunReport
+from SupplierProfile import load_profiles, find_profile
+from RunIO import recover_archive
+import QB_Invoice_Import_Generator as generator
+
+POLL_SECONDS = 2.0
+#A file counts as completely written once its size and modification time haven't changed for this long
+SETTLE_SECONDS = 5.0
+QUEUE_SIZE = 8
+#Hidden files and Excel's lock files (~$name.xlsx) are never inputs
+IGNORED_PREFIXES = ('.', '~$')
+
+class InvoiceWatcher:
+    def __init__(self, current_path='', workers=1, streaming=False, output_format='xlsx', incremental=False,
+                 poll_seconds=POLL_SECONDS, settle_seconds=SETTLE_SECONDS, queue_size=QUEUE_SIZE, upsert=False):
+        """
+        Long running alternative to double clicking the program: watches Input and processes every raw invoice and
+        customer file dropped there, one file at a time, without starting cold for each one.
+        The Master Reference stays parsed in memory with its lookup index between files, and is only read again if the workbook changes on disk.
+        Files are queued once they have settled (see SETTLE_SECONDS) on a bounded queue that the worker threads take them from.
+        Customer files update the Master Reference one at a time (upsert: see MasterReferenceUpdater); raw invoices of different months or suppliers are generated side by side.
+        Processed files are archived, each into its own run subfolder of Archive. A file that fails is left in Input and only tried again once it changes.
+        """
+        self.lm = lm(current_path)
+        self.profiles = load_profiles(self.lm.current_loc)
+        self.workers = workers
+        self.streaming = streaming
+        self.output_format = output_format
+        self.incremental = incremental
+        self.upsert = upsert
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.reference = None
+        self.reference_lock = threading.Lock()
+        self.month_locks = defaultdict(threading.Lock)
+        self.seen = {} #file name: ((size, mtime), when it was first seen like that)
+        #queued and failed are shared with the worker threads, so they're only read or changed with state_lock held
+        self.state_lock = threading.Lock()
+        self.queued = {} #file name: (size, mtime) it was queued with
+        self.failed = {} #file name: (size, mtime) it failed with
+        self.stop_event = threading.Event()
+
+    def is_input_file(self, name):
+        if name.startswith(IGNORED_PREFIXES):
+            return False
+        return any(profile.matches(name) for profile in self.profiles) or bool(re.search(CUSTOMER_FILE_PATTERN, name))
+
+    def scan(self):
+        """
+        Input files that have settled and aren't queued yet, customer files first so their customers are in the
+        Master Reference before an invoice that uses them. Files that failed are skipped until they change.
+        """
+        now = time.monotonic()
+        input_path = self.lm.get_input_path()
+        ready = []
+        present = set()
+        with self.state_lock:
+            queued, failed = set(self.queued), dict(self.failed)
+        for name in os.listdir(input_path):
+            if not self.is_input_file(name):
+                continue
+            try:
+                stat = os.stat(os.path.join(input_path, name))
+            except FileNotFoundError:
+                continue
+            present.add(name)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if name not in self.seen or self.seen[name][0] != signature:
+                self.seen[name] = (signature, now)
+                continue
+            settled = stat.st_size > 0 and now - self.seen[name][1] >= self.settle_seconds
+            if settled and name not in queued and failed.get(name) != signature:
+                ready.append((not re.search(CUSTOMER_FILE_PATTERN, name), stat.st_mtime_ns, name))
+        self.seen = {name: value for name, value in self.seen.items() if name in present}
+        with self.state_lock:
+            for name in set(self.failed) - present:
+                del self.failed[name]
+        return [(name, self.seen[name][0]) for _, _, name in sorted(ready)]
+
+    def enqueue(self, files):
+        """Queues (name, signature) pairs until the queue is full. The rest are picked up again on a later poll."""
+        for name, signature in files:
+            #Recorded before the put, so a worker that takes the file straight away finds it
+            with self.state_lock:
+                self.queued[name] = signature
+            try:
+                self.jobs.put_nowait(name)
+            except queue.Full:
+                with self.state_lock:
+                    del self.queued[name]
+                return
+
+    def get_reference(self):
+        """The warm ReferenceContext, loaded again only if the workbook changed on disk. Call with reference_lock held."""
+        if self.reference is None or self.reference.is_stale():
+            self.reference = ReferenceContext(self.lm.get_reference_path())
+        return self.reference
+
+    def update_reference(self, name, report):
+        """Adds the customers of one customer file to the Master Reference, then checks and saves it like main does."""
+        current_path = self.lm.current_loc
+        with self.reference_lock:
+            reference = self.get_reference()
+            with report.stage('MasterReferenceUpdater.RUN', reference.customer_list.shape[0], name):
+                umr = MasterReferenceUpdater(current_path, reference, self.upsert, input_files=[name])
+                umr.RUN()
+            with report.stage('SanityCheck.run_check', reference.customer_list.shape[0], name):
+                passed_checks = generator.SanityCheck(reference, current_path).run_check()
+            if not passed_checks:
+                #The in memory reference has the rejected customers in it, so it's read from disk again for the next file
+                self.reference = None
+                error_popup(f'Failed to add {name}. One or more tests failed. See REFERENCE_ERROR for details.')
+                return False
+            if not umr.save_reference():
+                self.reference = None
+                error_popup(umr.FAILED)
+                return False
+            return True
+
+    def generate(self, name, report):
+        """Generates one raw invoice. Invoices of the same supplier and month wait for each other (incremental drops build on each other)."""
+        current_path = self.lm.current_loc
+        raw_invoice_path = os.path.join(self.lm.get_input_path(), name)
+        profile = find_profile(name, self.profiles)
+        with self.month_locks[(profile.name, generator.invoice_month(raw_invoice_path))]:
+            with self.reference_lock:
+                reference = self.get_reference()
+                with report.stage('SanityCheck.run_check', reference.price_reference.shape[0], name):
+                    passed_checks = generator.SanityCheck(reference, current_path).run_check([raw_invoice_path])
+                if not passed_checks:
+                    error_popup(f'Failed to generate {name}. One or more tests failed. See REFERENCE_ERROR for details.')
+                    return False
+                #Builds the supplier's customers and lookup index on the shared reference (once), so it's done under the lock
+                rg = generator.ReportGenerator(streaming=self.streaming, raw_invoice_path=raw_invoice_path, reference=reference, output_format=self.output_format,
+                                               current_path=current_path, report=report, incremental=self.incremental, profile=profile)
+            return rg.generate_csv(archive=False)
+
+    def process(self, name):
+        """Processes and archives one Input file. Returns True if it went through."""
+        report = RunReport()
+        start = time.perf_counter()
+        if re.search(CUSTOMER_FILE_PATTERN, name):
+            processed = self.update_reference(name, report)
+        else:
+            processed = self.generate(name, report)
+        if processed:
+            generator.archive_inputs(self.lm.current_loc, [name])
+        report.write(self.lm.get_output_path(), f'RUN_REPORT {os.path.splitext(name)[0]}')
+        log.info('Processed' if processed else 'Failed', extra={'fields': {'file': name, 'seconds': round(time.perf_counter() - start, 3)}})
+        return processed
+
+    def work(self):
+        """Worker thread: processes queued files until it gets None."""
+        while True:
+            name = self.jobs.get()
+            if name is None:
+                return
+            processed = False
+            try:
+                processed = self.process(name)
+            except Exception:
+                log.exception(f'Failed to process {name}', extra={'fields': {'file': name}})
+            finally:
+                with self.state_lock:
+                    signature = self.queued.pop(name, None)
+                    if not processed and signature is not None:
+                        self.failed[name] = signature
+
+    def stop(self):
+        """Stops watching. Files already queued are still processed."""
+        self.stop_event.set()
+
+    def run(self):
+        """Watches Input until stop() is called (or Ctrl+C)."""
+        recovered = recover_archive(self.lm.current_loc)
+        if recovered:
+            log.warning('Finished an interrupted archive', extra={'fields': {'runs': recovered}})
+        with self.reference_lock:
+            self.get_reference()
+        threads = [threading.Thread(target=self.work, name=f'invoice-worker-{i+1}') for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        log.info('Watching', extra={'fields': {'input': self.lm.get_input_path(), 'workers': self.workers, 'poll_seconds': self.poll_seconds, 'settle_seconds': self.settle_seconds}})
+        try:
+            while not self.stop_event.is_set():
+                self.enqueue(self.scan())
+                self.stop_event.wait(self.poll_seconds)
+        finally:
+            for _ in threads:
+                self.jobs.put(None)
+            for thread in threads:
+                thread.join()
+            log.info('Stopped watching')
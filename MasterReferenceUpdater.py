@@ -1,96 +1,213 @@
 import pandas as pd 
+import numpy as np
 import os
 import re
-from numpy import setdiff1d
+import json
+from datetime import datetime
 from PathManager import locationManager as lm
-from ErrorLogging import error_popup
-import openpyxl
+from ErrorLogging import error_popup, log
+from ReferenceContext import ReferenceContext
+from ReferenceCache import file_sha256
+
+CUSTOMER_FILE_PATTERN = 'customer'
+#Fingerprints of the customer files already merged into the Master Reference, kept with the incremental invoice states
+CUSTOMER_MANIFEST = os.path.join('State', 'CustomerManifest.json')
+
+def read_customer_file(path):
+    """
+    One customer export as a dataframe. Workbooks are streamed row by row in openpyxl's read only mode instead of
+    being loaded whole. Blank rows are skipped and blank cells are NaN, the same frame pd.read_excel returns.
+    """
+    if '.csv' in os.path.basename(path):
+        return pd.read_csv(path)
+    import openpyxl #only customer workbooks need it, so it isn't imported with the generator
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        records = [row for row in rows if any(value is not None for value in row)]
+    finally:
+        workbook.close()
+    return pd.DataFrame.from_records(records, columns=header).fillna(np.nan).infer_objects()
 
 class MasterReferenceUpdater:
-    def __init__(self, current_path = ''):
+    def __init__(self, current_path = '', reference = None, upsert = False, input_files = None):
+        """
+        reference is the run's shared ReferenceContext. When one is passed in, RUN only updates it in memory and
+        the caller saves it once the run has validated. Without one, the updater loads and saves the workbook itself.
+        With upsert=True, customers whose Record ID already exists have their fields updated from the new file instead of being ignored.
+        input_files (names in Input) limits the customer file search to those files, e.g. the one file the watcher is processing.
+        Every customer file found is merged in one pass, oldest first, so a later export wins for a Record ID in several files.
+        Files whose contents were already applied (see CUSTOMER_MANIFEST) are skipped without being parsed.
+        They are recorded there once save_reference has written them to the Master Reference.
+        """
         self.FAILED = 'Failures:' #length == 9 for check
         self.lm = lm(current_path) 
         self.ref_path = self.lm.get_reference_path()
         self.input_path = self.lm.get_input_path()
         self.archive_path = self.lm.get_archive_path()
+        self.owns_reference = reference is None
+        self.reference = reference if reference is not None else self.load_reference()
         self.master_ref_df = self.load_master_ref()
         self.new_customer_df = None 
+        self.existing_customer_df = None
+        self.upsert = upsert
+        self.input_files = input_files
+        self.manifest_path = os.path.join(self.lm.current_loc, CUSTOMER_MANIFEST)
+        self.manifest = self.load_manifest()
+        self.fingerprints = {} #fingerprint: file name of the files merged this run
+        self.CHANGES = [] #(Change, Record ID, PLN Stock Lens Account Number, Details) rows for REFERENCE_CHANGES.csv
     
     def append_FAILED(self, msg):
         self.FAILED = self.FAILED + '\n' + msg
         
-    def load_master_ref(self):
-        """Load existing master reference into dataframe."""
+    def load_reference(self):
+        """Load existing master reference."""
         try:
-            return pd.read_excel(self.ref_path, sheet_name='CustomerList', engine='openpyxl')
+            return ReferenceContext(self.ref_path)
         except:
-            self.append_FAILED('Failed to load Master Ref CustomerList')
-            return False
+            self.append_FAILED('Failed to load Master Ref')
+            return None
 
-    def load_master_price_ref(self):
-        """Load existing master reference Price Sheet into dataframe"""
-        try:
-            return pd.read_excel(self.ref_path, sheet_name='PriceSheet', engine='openpyxl')
-        except:
-            self.append_FAILED('Failed to load Master Ref PriceSheet')
+    def load_master_ref(self):
+        """Existing master reference CustomerList as a dataframe."""
+        if self.reference is None:
+            self.append_FAILED('Failed to load Master Ref CustomerList')
             return False
+        return self.reference.customer_list
     
+    def load_manifest(self):
+        """{fingerprint: details} of the customer files already applied. A missing or unreadable manifest just means nothing is skipped."""
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def is_applied(self, fingerprint):
+        """True if a file with these contents was already applied, in upsert mode if this run upserts."""
+        applied = self.manifest.get(fingerprint)
+        return applied is not None and (applied['upsert'] or not self.upsert)
+
+    def save_manifest(self):
+        """Records the files merged this run, replacing the old manifest only once the new one is completely written."""
+        if not self.fingerprints:
+            return
+        applied_at = datetime.now().isoformat(timespec='seconds')
+        for fingerprint, input_file in self.fingerprints.items():
+            self.manifest[fingerprint] = {'file': input_file, 'applied': applied_at, 'upsert': self.upsert}
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
+        self.fingerprints = {}
+
     def load_newest_files(self):
-        """Get the new files containing the new customer list and load it into a dataframe."""
-        input_files = os.listdir(self.input_path)
-        raw_pattern = 'customer'
-        for input_file in input_files:
-            if re.search(raw_pattern, input_file):
-                if '.csv' in input_file:
-                    self.new_customer_df = pd.read_csv(os.path.join(self.input_path, input_file))
-                else:
-                    self.new_customer_df = pd.read_excel(os.path.join(self.input_path, input_file), engine='openpyxl')
-                return True
-        return False
+        """Get the new files containing the new customer list and merge them into one dataframe."""
+        input_files = os.listdir(self.input_path) if self.input_files is None else self.input_files
+        paths = [os.path.join(self.input_path, input_file) for input_file in input_files if re.search(CUSTOMER_FILE_PATTERN, input_file)]
+        for path in sorted(paths, key=os.path.getmtime):
+            #Contents, not the name, so a renamed or re-dropped copy of the same export is recognised
+            fingerprint = file_sha256(path)
+            if self.is_applied(fingerprint) or fingerprint in self.fingerprints:
+                log.info('Customer file already applied', extra={'fields': {'file': os.path.basename(path)}})
+                continue
+            customers = read_customer_file(path)
+            if self.new_customer_df is None:
+                self.new_customer_df = customers
+            else:
+                earlier = self.new_customer_df[~self.new_customer_df['Record ID'].isin(customers['Record ID'])]
+                self.new_customer_df = pd.concat([earlier, customers], ignore_index=True)
+            self.fingerprints[fingerprint] = os.path.basename(path)
+        return self.new_customer_df is not None
     
+    def append_CHANGES(self, change, customers, details=None):
+        """Adds one change report line per customer row."""
+        details = details if details is not None else [''] * customers.shape[0]
+        for record_id, PLN_No, detail in zip(customers['Record ID'], customers['PLN Stock Lens Account Number'], details):
+            self.CHANGES.append((change, record_id, PLN_No, detail))
+
     def compare_new_to_existing_reference(self):
-        """Identify customers that currently don't exist in the master reference."""
-        old_customers = list(self.master_ref_df['Record ID'].unique())
-        temp_customers = list(self.new_customer_df['Record ID'].unique())
-        new_customers = setdiff1d(temp_customers, old_customers)
-        temp = self.new_customer_df.copy()
-        temp['KEEP'] = temp['Record ID'].apply(lambda x: True if x in new_customers else False)
-        result = temp[temp['KEEP']==True]
-        result.drop(['KEEP'], axis=1, inplace=True)
-        self.new_customer_df = result
+        """Identify customers that currently don't exist in the master reference (anti-join on Record ID)."""
+        self.master_ref_df = self.master_ref_df.reset_index(drop=True)
+        is_existing = self.new_customer_df['Record ID'].isin(self.master_ref_df['Record ID'])
+        self.existing_customer_df = self.new_customer_df[is_existing]
+        self.new_customer_df = self.new_customer_df[~is_existing]
+        self.append_CHANGES('Added', self.new_customer_df)
+
+    def update_existing_customers(self):
+        """Upsert: copy changed fields of customers that already exist onto their Master Reference row. The last row per Record ID wins."""
+        updates = self.existing_customer_df.drop_duplicates(subset='Record ID', keep='last').set_index('Record ID')
+        columns = [column for column in updates.columns if column in self.master_ref_df.columns and column != 'Record ID']
+        matched = self.master_ref_df['Record ID'].isin(updates.index)
+        old_values = self.master_ref_df.loc[matched, columns]
+        new_values = updates.reindex(self.master_ref_df.loc[matched, 'Record ID'])[columns]
+        new_values.index = old_values.index
+        changed_cells = ~((old_values == new_values) | (old_values.isna() & new_values.isna()))
+        changed_rows = changed_cells.any(axis=1)
+        if not changed_rows.any():
+            self.existing_customer_df = self.existing_customer_df.iloc[0:0]
+            return
+        changed_cells, old_values, new_values = changed_cells[changed_rows], old_values[changed_rows], new_values[changed_rows]
+        details = ['; '.join(f'{column}: {old_values.at[i, column]} -> {new_values.at[i, column]}' for column in columns if changed_cells.at[i, column]) for i in changed_cells.index]
+        self.master_ref_df.loc[changed_cells.index, columns] = new_values
+        self.existing_customer_df = self.master_ref_df.loc[changed_cells.index]
+        self.append_CHANGES('Updated', self.existing_customer_df, details)
+        PLN_column = 'PLN Stock Lens Account Number'
+        if PLN_column in columns:
+            #The customer's old PLN number, listed under it so it can be looked up in the report
+            superseded = changed_cells[PLN_column]
+            old_PLN_Nos = old_values.loc[superseded, [PLN_column]].assign(**{'Record ID': self.existing_customer_df.loc[superseded, 'Record ID']})
+            self.append_CHANGES('Superseded', old_PLN_Nos, [f'Superseded by PLN No {PLN_No}' for PLN_No in new_values.loc[superseded, PLN_column]])
 
     def overwrite_old_PLN_Nos(self):
-        taken_PLN_Nos = list(self.new_customer_df['PLN Stock Lens Account Number'].unique())
-        self.master_ref_df['KEEP'] = self.master_ref_df['PLN Stock Lens Account Number'].apply(lambda x: True if x not in taken_PLN_Nos else False)
-        self.master_ref_df = self.master_ref_df[self.master_ref_df['KEEP']]
-        self.master_ref_df.drop(columns=['KEEP'], inplace=True)
+        """Drop old customers whose PLN number now belongs to a new (or upserted) customer."""
+        taking = pd.concat([self.new_customer_df, self.existing_customer_df]) if self.upsert else self.new_customer_df
+        is_taken = self.master_ref_df['PLN Stock Lens Account Number'].isin(taking['PLN Stock Lens Account Number']) & ~self.master_ref_df['Record ID'].isin(taking['Record ID'])
+        replaced = self.master_ref_df[is_taken]
+        new_owner = taking.drop_duplicates(subset='PLN Stock Lens Account Number', keep='last').set_index('PLN Stock Lens Account Number')['Record ID']
+        self.append_CHANGES('Replaced', replaced, [f'PLN No now belongs to Record ID {new_owner.get(PLN_No)}' for PLN_No in replaced['PLN Stock Lens Account Number']])
+        self.master_ref_df = self.master_ref_df[~is_taken]
     
     def update_reference(self):
         """Add new customers into existing reference."""
-        self.master_ref_df = self.master_ref_df.append(self.new_customer_df)
+        if not self.CHANGES:
+            return False
+        self.master_ref_df = pd.concat([self.master_ref_df, self.new_customer_df])
+        self.reference.set_customer_list(self.master_ref_df)
+        return True
+
+    def write_change_report(self):
+        """Write the added/updated/replaced/superseded customers to REFERENCE_CHANGES.csv next to the program."""
+        if not self.CHANGES:
+            return False
+        report = pd.DataFrame(self.CHANGES, columns=['Change', 'Record ID', 'PLN Stock Lens Account Number', 'Details'])
+        report.to_csv(os.path.join(self.lm.current_loc, 'REFERENCE_CHANGES.csv'), index=False)
         return True
     
     def save_reference(self):
         """Save master reference."""
-        price_reference = self.load_master_price_ref()
-        if True  in [self.master_ref_df.empty, price_reference.empty]:
+        if self.reference is None or True in [self.reference.customer_list.empty, self.reference.price_reference.empty]:
             self.append_FAILED('Failed to save Master reference.')
             return False
-        writer = pd.ExcelWriter(self.ref_path, engine='xlsxwriter')
-        self.master_ref_df.to_excel(writer, index=False, sheet_name='CustomerList')
-        price_reference.to_excel(writer, index=False, sheet_name='PriceSheet')
-        writer.save()
+        self.reference.save()
+        self.save_manifest()
         return True
     
     def RUN(self):
         new_customers_found = self.load_newest_files()
         if new_customers_found:
             self.compare_new_to_existing_reference()
+            if self.upsert:
+                self.update_existing_customers()
             self.overwrite_old_PLN_Nos() #Make sure solution is acceptable
             self.update_reference()
-            self.save_reference()
+            self.write_change_report()
+            if self.owns_reference:
+                self.save_reference()
         else:
-            print('No new customers found.') 
+            log.info('No new customers found')
         if len(self.FAILED)>9:
             error_popup(self.FAILED)
 
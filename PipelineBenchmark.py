@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+#name: (customers, UPCs, raw invoice rows)
+SCALES = {
+    'small': (300, 200, 12000),
+    'medium': (2000, 1000, 100000),
+    'large': (5000, 3000, 500000),
+}
+NEW_CUSTOMERS = 50
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def run_one(folder, trace_memory, streaming):
+    """Runs main() end to end on a synthetic folder in this process and prints the run report stages as JSON."""
+    from ErrorLogging import configure_logging
+    from RunReport import RunReport
+    import QB_Invoice_Import_Generator as generator
+    configure_logging(interactive=False)
+    report = RunReport(trace_memory)
+    exit_code = generator.main(folder, streaming=streaming, archive=False, report=report)
+    print(json.dumps({'exit_code': exit_code, 'stages': report.stages}))
+
+def run_scale(scale, trace_memory, streaming):
+    """Builds the scale's data set in a temporary folder and runs it in a fresh process, so memory figures aren't shared between runs."""
+    from SyntheticData import make_dataset
+    customers, upcs, rows = SCALES[scale]
+    with tempfile.TemporaryDirectory() as folder:
+        make_dataset(folder, customers, upcs, rows, new_customers=NEW_CUSTOMERS)
+        command = [sys.executable, os.path.abspath(__file__), '--one', folder] + (['--trace-memory'] if trace_memory else []) + (['--streaming'] if streaming else [])
+        output = subprocess.run(command, cwd=HERE, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    if result['exit_code'] != 0:
+        raise RuntimeError(f'{scale} run failed with exit code {result["exit_code"]}')
+    return result['stages']
+
+def merge_runs(timed, traced):
+    """Per stage results: timing from the plain run, heap peaks from the tracemalloc run (which is slower, so its times aren't used)."""
+    peaks = {(stage['stage'], stage['invoice']): stage['peak_traced_mb'] for stage in traced}
+    results = []
+    for stage in timed:
+        rows = stage['rows_in']
+        results.append({'stage': stage['stage'], 'seconds': stage['seconds'], 'rows_in': rows,
+                        'rows_per_second': round(rows / stage['seconds'], 1) if rows and stage['seconds'] else None,
+                        'peak_rss_mb': stage['peak_rss_mb'], 'peak_traced_mb': peaks.get((stage['stage'], stage['invoice']))})
+    return results
+
+def print_results(scale, results, baseline=None):
+    """Table of one scale's stages. With a baseline, the last column is the time change against it."""
+    print(f'\n{scale} {SCALES[scale]} (customers, UPCs, rows)')
+    print(f'{"stage":>32} {"seconds":>9} {"rows/s":>10} {"rss MB":>8} {"heap MB":>8} {"vs base":>8}')
+    base = {result['stage']: result for result in (baseline or [])}
+    for result in results:
+        change = ''
+        if result['stage'] in base and base[result['stage']]['seconds']:
+            change = f'{(result["seconds"] / base[result["stage"]]["seconds"] - 1) * 100:+.0f}%'
+        rows_per_second = '' if result['rows_per_second'] is None else result['rows_per_second']
+        heap = '' if result['peak_traced_mb'] is None else result['peak_traced_mb']
+        rss = '' if result['peak_rss_mb'] is None else result['peak_rss_mb']
+        print(f'{result["stage"]:>32} {result["seconds"]:>9.3f} {rows_per_second:>10} {rss:>8} {heap:>8} {change:>8}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End to end benchmark of the invoice pipeline on synthetic data.')
+    parser.add_argument('scales', nargs='*', help=f'scales to run, any of {", ".join(SCALES)} (default: small medium)')
+    parser.add_argument('--streaming', action='store_true', help='benchmark the streaming generator')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run (per stage heap peaks)')
+    parser.add_argument('--save', help='write the results to this JSON file, e.g. to keep as a baseline')
+    parser.add_argument('--baseline', help='JSON file from an earlier --save to compare the times against')
+    parser.add_argument('--one', help=argparse.SUPPRESS)
+    parser.add_argument('--trace-memory', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.one:
+        return run_one(args.one, args.trace_memory, args.streaming)
+    unknown = [scale for scale in args.scales if scale not in SCALES]
+    if unknown:
+        parser.error(f'unknown scale(s) {", ".join(unknown)}')
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    all_results = {}
+    for scale in args.scales or ['small', 'medium']:
+        timed = run_scale(scale, False, args.streaming)
+        traced = [] if args.no_memory else run_scale(scale, True, args.streaming)
+        all_results[scale] = merge_runs(timed, traced)
+        print_results(scale, all_results[scale], baseline.get(scale))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+from ReferenceIndex import ReferenceIndex
+
+#Optional Master Reference sheets. A blank key cell matches anything, blank dates leave the rule open ended.
+PRICE_RULES_SHEET = 'PriceRules'
+DISCOUNT_RULES_SHEET = 'DiscountRules'
+#sheet: (key columns, volume break column, value column)
+RULE_SHEETS = {
+    PRICE_RULES_SHEET: (['UPC', 'Category', 'Pivotal Account'], 'Min Qty', 'Retail'),
+    DISCOUNT_RULES_SHEET: (['Category', 'Pivotal Account'], 'Min Amount', 'Rate'),
+}
+
+def to_dates(values):
+    """Dates (datetime64) of ShipDate style values. Categoricals are parsed once per category instead of once per row."""
+    values = pd.Series(values)
+    if values.dtype == 'category':
+        categories = pd.to_datetime(pd.Series(values.cat.categories), errors='coerce').values
+        codes = values.cat.codes.values
+        return np.where(codes >= 0, categories[codes], np.datetime64('NaT'))
+    return pd.to_datetime(values, errors='coerce').values
+
+def compile_rules(sheet, keys, volume, value):
+    """
+    A rule sheet as a frame the matching joins use: the keys normalised to the invoice's types, missing volume breaks as 0,
+    and a Priority (higher wins) so one rule can be picked per row. Rows without a value are dropped (SanityCheck reports them).
+    A rule that names more keys wins, then the highest volume break reached, then the latest Start Date, then the lowest row.
+    """
+    rules = pd.DataFrame({
+        'Min': pd.to_numeric(sheet.get(volume), errors='coerce'),
+        'Start': pd.to_datetime(sheet.get('Start Date'), errors='coerce'),
+        'End': pd.to_datetime(sheet.get('End Date'), errors='coerce'),
+        'Value': pd.to_numeric(sheet.get(value), errors='coerce'),
+    }, index=sheet.index)
+    for key in keys:
+        column = sheet[key] if key in sheet.columns else pd.Series(np.nan, index=sheet.index)
+        rules[key] = ReferenceIndex.upc_keys(column).astype('float64') if key == 'UPC' else column.where(column.notna(), np.nan).astype(object)
+    rules = rules[rules['Value'].notna()].reset_index(drop=True)
+    rules['Min'] = rules['Min'].fillna(0)
+    rules['Pattern'] = [tuple(key for key, given in zip(keys, row) if given) for row in rules[keys].notna().values]
+    specificity = rules['Pattern'].map(len).values
+    start = rules['Start'].fillna(pd.Timestamp.min).values
+    order = np.lexsort((-np.arange(rules.shape[0]), start, rules['Min'].values, specificity))
+    rules['Priority'] = np.empty(rules.shape[0], dtype='int64')
+    rules.loc[order, 'Priority'] = np.arange(rules.shape[0])
+    return rules
+
+def combine_codes(codes, sizes, length):
+    """One int64 code per row (of length) for a combination of factorized columns (codes -1 for missing values, sizes their number of uniques)."""
+    combined = np.zeros(length, dtype='int64')
+    for column_codes, size in zip(codes, sizes):
+        combined = combined*(size+1) + (column_codes+1)
+    return combined
+
+def best_rule_values(frame, rules, keys):
+    """
+    Value of the best matching rule for every row of frame (NaN where none matches). frame has the key columns,
+    Volume (compared to the rule's break) and Date (compared to its Start and End Date).
+    Rules are matched per combination of keys they use, against the distinct (keys, Volume, Date) values of the rows rather than
+    the rows themselves, then mapped back. So the work grows with the distinct values and the rules per key, not rows times rules.
+    """
+    values = np.full(frame.shape[0], np.nan)
+    if rules is None or rules.empty or frame.empty:
+        return values
+    factorized = {column: pd.factorize(frame[column]) for column in keys + ['Volume', 'Date']}
+    codes = {column: column_codes for column, (column_codes, _) in factorized.items()}
+    uniques = {column: pd.Index(column_uniques) for column, (_, column_uniques) in factorized.items()}
+    volumes, dates = frame['Volume'].values, frame['Date'].values
+    best_priority = np.full(frame.shape[0], -1, dtype='int64')
+    for pattern, pattern_rules in rules.groupby('Pattern', sort=False):
+        pattern = list(pattern)
+        sizes = [len(uniques[key]) for key in pattern]
+        rule_codes = [uniques[key].get_indexer(pattern_rules[key]) for key in pattern]
+        known = np.all(np.array(rule_codes) >= 0, axis=0) if pattern else np.ones(pattern_rules.shape[0], dtype=bool)
+        if not known.any():
+            continue
+        pattern_rules = pattern_rules[known].assign(Key=combine_codes([column_codes[known] for column_codes in rule_codes], sizes, known.sum()))
+        row_keys = combine_codes([codes[key] for key in pattern], sizes, frame.shape[0])
+        combo_of_row, combos = pd.factorize(combine_codes([row_keys, codes['Volume'], codes['Date']],
+                                                          [row_keys.max()+1, len(uniques['Volume']), len(uniques['Date'])], frame.shape[0]))
+        #Every row of a combination has the same keys, Volume and Date, so any one of them stands for it
+        sample_rows = np.empty(len(combos), dtype='int64')
+        sample_rows[combo_of_row] = np.arange(frame.shape[0])
+        distinct = pd.DataFrame({'Key': row_keys[sample_rows], 'Volume': volumes[sample_rows], 'Date': dates[sample_rows], 'Combo': np.arange(len(combos))})
+        matched = distinct.merge(pattern_rules[['Key', 'Min', 'Start', 'End', 'Value', 'Priority']], on='Key')
+        matched = matched[(matched['Volume'] >= matched['Min']) & ~(matched['Date'] < matched['Start']) & ~(matched['Date'] > matched['End'])]
+        best = matched.sort_values('Priority').drop_duplicates('Combo', keep='last')
+        combo_priority = np.full(len(combos), -1, dtype='int64')
+        combo_value = np.full(len(combos), np.nan)
+        combo_priority[best['Combo'].values] = best['Priority'].values
+        combo_value[best['Combo'].values] = best['Value'].values
+        row_priority = combo_priority[combo_of_row]
+        better = row_priority > best_priority
+        best_priority[better] = row_priority[better]
+        values[better] = combo_value[combo_of_row][better]
+    return values
+
+
+class PricingRules:
+    def __init__(self, sheets):
+        """
+        The PriceRules and DiscountRules sheets of the Master Reference (sheets: {sheet name: frame}, either may be missing),
+        compiled once and evaluated over whole frames.
+        PriceRules replace the PriceSheet Retail of a UPC and/or Category, for all or one Pivotal Account, from a Min Qty per row
+        (volume breaks, returns counted by their size) and between a Start and End Date (the row's ShipDate).
+        DiscountRules set the discount Rate of a customer's month on a Category and/or Pivotal Account, from a Min Amount
+        (the customer's retail total for the month) and between a Start and End Date (the invoice date).
+        Without the sheets, prices and discounts are exactly what they were without rules.
+        """
+        self.price_rules = self.compile(sheets, PRICE_RULES_SHEET)
+        self.discount_rules = self.compile(sheets, DISCOUNT_RULES_SHEET)
+
+    @staticmethod
+    def compile(sheets, sheet_name):
+        sheet = sheets.get(sheet_name)
+        if sheet is None or sheet.empty:
+            return None
+        return compile_rules(sheet, *RULE_SHEETS[sheet_name])
+
+    def unit_prices(self, raw, retail):
+        """NewUnit$ of enriched raw invoice rows: retail (the PriceSheet price of each row) where no PriceRule applies."""
+        if self.price_rules is None:
+            return retail
+        retail = np.asarray(retail, dtype='float64')
+        frame = pd.DataFrame({
+            'UPC': ReferenceIndex.upc_keys(raw['Barcode']).astype('float64').values,
+            'Category': np.asarray(raw['Category'], dtype=object),
+            'Pivotal Account': np.asarray(raw['Pivotal Account'], dtype=object),
+            'Volume': np.abs(raw['ShipQty'].values),
+            'Date': to_dates(raw['ShipDate']),
+        })
+        prices = best_rule_values(frame, self.price_rules, RULE_SHEETS[PRICE_RULES_SHEET][0])
+        return np.where(np.isnan(prices), retail, prices)
+
+    def discounts(self, pivotal_accounts, base_rates, totals, category_totals, invoice_date):
+        """
+        Discount (unrounded) of every customer in pivotal_accounts. totals are the customers' retail month totals (NewShipAmount per
+        Pivotal Account), category_totals the same per (Pivotal Account, Category). base_rates is each customer's rate without rules.
+        Each customer's categories are discounted at the best matching DiscountRule's Rate, or at the base rate if none matches.
+        """
+        amounts = totals.reindex(pivotal_accounts, fill_value=0).values
+        discounts = amounts * base_rates
+        if self.discount_rules is None or category_totals is None or category_totals.empty:
+            return discounts
+        groups = category_totals.reset_index()
+        groups = groups[groups['Pivotal Account'].isin(pivotal_accounts)].reset_index(drop=True)
+        base = pd.Series(base_rates, index=pivotal_accounts)
+        base = base[~base.index.duplicated()]
+        frame = pd.DataFrame({
+            'Category': groups['Category'].astype(object).values,
+            'Pivotal Account': groups['Pivotal Account'].astype(object).values,
+            'Volume': totals.reindex(groups['Pivotal Account']).values,
+            'Date': np.full(groups.shape[0], np.datetime64(invoice_date, 'ns')),
+        })
+        rates = best_rule_values(frame, self.discount_rules, RULE_SHEETS[DISCOUNT_RULES_SHEET][0])
+        ruled = ~np.isnan(rates)
+        if not ruled.any():
+            return discounts
+        #Only the difference to the base rate is added, so customers no rule applies to keep exactly the discount they had without rules
+        extra = groups.loc[ruled, 'NewShipAmount'].values * (rates[ruled] - base.reindex(groups.loc[ruled, 'Pivotal Account']).values)
+        extra = pd.Series(extra).groupby(groups.loc[ruled, 'Pivotal Account'].values).sum()
+        return discounts + extra.reindex(pivotal_accounts, fill_value=0).values
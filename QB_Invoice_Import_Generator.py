@@ -1,89 +1,215 @@
-from cv2 import dft
 import pandas as pd
 import sys
 import os
 from datetime import date, datetime
 from calendar import monthrange, month_name
 import re
-import tkinter as tk
-import openpyxl
-import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support
 from MasterReferenceUpdater import MasterReferenceUpdater
+from ReferenceContext import ReferenceContext
+from ReferenceIndex import ReferenceIndex
+from WorkbookWriter import open_writer, SheetSpool
+from RunReport import RunReport
+from InvoiceState import InvoiceState
+from InvoiceTotals import InvoiceTotals, money_sum
+from InvoiceHistory import InvoiceHistory, store_history
+from StageScheduler import StageScheduler
+from InvoiceSchema import raw_invoice_dtypes, constant_column, customer_keys
+from RunIO import RunIO, InputArchive, archive_inputs, archived_files, recover_archive, read_raw_invoice
+from SupplierProfile import DEFAULT_PROFILE, load_profiles, find_profile
+from PricingRules import RULE_SHEETS, to_dates
+from InvoiceSequence import InvoiceSequence, format_invoice_numbers
+from ErrorLogging import error_popup, log, EXIT_OK, EXIT_FAILED, EXIT_NO_INVOICE
+
+STREAMING_CHUNKSIZE = 50000
+#Sheets written after the Lens Import sheets, in workbook order: (sheet name, ReportGenerator attribute, generate_csv stage that builds it)
+REPORT_SHEETS = [('Taxes', 'TaxSheet', 'generate_Tax_Sheet'),
+                 ('Shipping Import', 'ShippingImport', 'generate_Shipping_Import'),
+                 ('Discount Import', 'DiscountImport', 'generate_Discount_Import'),
+                 ('Lens Returns Credits', 'LensReturnsCredits', 'generate_Lens_Returns_Credits'),
+                 ('Summary Details', 'SummarySheet', 'generate_Summary_Sheet'),
+                 ('Summary Overview', 'SummaryOverviewSheet', 'generate_Summary_Overview')]
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
+MONTH_NAME_PATTERN = re.compile('|'.join(MONTHS))
+#A four digit year on its own, so the digits of a supplier code (H02345) or a longer number aren't taken for one
+YEAR_PATTERN = re.compile(r'(?<!\d)(?:19|20)\d\d(?!\d)')
+#(raw invoice path, size, mtime): month its ShipDates are in, for raw invoices without the month in their name
+_shipdate_months = {}
+
+def find_raw_invoices(input_path, profiles=(DEFAULT_PROFILE,)):
+    """Returns every raw invoice in the input folder of the suppliers in profiles (SupplierProfiles)."""
+    return [os.path.join(input_path, input_file) for input_file in os.listdir(input_path) if any(profile.matches(input_file) for profile in profiles)]
+
+def find_archived_raw_invoices(current_location, profiles=(DEFAULT_PROFILE,)):
+    """Returns every raw invoice in Archive (all its run subfolders, the newest copy of each file) of the suppliers in profiles."""
+    return [path for path in archived_files(os.path.join(current_location, 'Archive')) if any(profile.matches(path) for profile in profiles)]
+
+def invoice_month(raw_invoice_path, raw_invoice=None):
+    """
+    Month the raw invoice is for, from the month name and year in its file name (not the folders, Archive run folders are dated).
+    A file name without both falls back to the month most of its ShipDates are in. raw_invoice is the invoice's frame if it's
+    already read; otherwise only the ShipDate column is read, once per file.
+    """
+    file_name = os.path.basename(raw_invoice_path)
+    month_name = MONTH_NAME_PATTERN.search(file_name)
+    year = YEAR_PATTERN.search(file_name)
+    if month_name and year:
+        return date(int(year.group()), MONTHS.index(month_name.group())+1, 1)
+    if raw_invoice is not None:
+        month = shipdate_month(raw_invoice['ShipDate'])
+    else:
+        stat = os.stat(raw_invoice_path)
+        key = (os.path.abspath(raw_invoice_path), stat.st_size, stat.st_mtime_ns)
+        if key not in _shipdate_months:
+            _shipdate_months[key] = shipdate_month(pd.read_csv(raw_invoice_path, usecols=['ShipDate'], dtype={'ShipDate': 'category'})['ShipDate'])
+        month = _shipdate_months[key]
+    if month is None:
+        raise ValueError(f'No month in the name of {file_name} (e.g. "March 2023") and no ShipDate to take it from')
+    return month
+
+def shipdate_month(ship_dates):
+    """First day of the month most ShipDates are in, or None if none of them is a date. Categoricals are parsed once per category."""
+    months = pd.Series(to_dates(ship_dates)).dropna().values.astype('datetime64[M]')
+    if not len(months):
+        return None
+    return pd.Timestamp(pd.Series(months).value_counts().idxmax()).date()
+
 class SanityCheck:
     
-    def __init__(self):
+    def __init__(self, reference=None, current_path=''):
         """
         Does the checks for Master Reference to prevent errors from getting into the invoice generator.
+        reference is the run's ReferenceContext; the checks run on it directly instead of re-reading the workbook.
+        current_path is the folder holding MasterReference, Input and Output (default: next to the program).
         Desired Features (copied from customer message)
         1. If there's a customer that has a Pivotal Group number, but no Stock Lens account number? (Or vis versa). So basically if there was a blank box in either of the columns for this info
         2. If there's a duplicate Pivotal Group number identified
         3. If there's a duplicate Stock lens account number identified.
+        Every check is a vectorized mask. Findings are collected in a list with the sheet row number, the offending value and
+        the whole row, and the log frame is only built once at the end of run_check.
         """
         #self.current_location = os.path.dirname(os.path.abspath(__file__)) #use this line for local development
-        self.current_location = os.path.dirname(sys.executable)
-        reference_path = os.path.join(self.current_location, 'MasterReference.xlsx')
-        self.price_reference = pd.read_excel(reference_path, sheet_name='PriceSheet', engine='openpyxl')
-        self.customer_list = pd.read_excel(reference_path, sheet_name='CustomerList', engine='openpyxl')
+        self.current_location = current_path or os.path.dirname(sys.executable)
+        if reference is None:
+            reference = ReferenceContext(os.path.join(self.current_location, 'MasterReference.xlsx'))
+        self.price_reference = reference.price_reference
+        self.customer_list = reference.customer_list
+        self.rule_sheets = reference.rule_sheets
         self.Passed = False
-        self.LOG = pd.DataFrame(columns = ['Description', 'Location'])
+        self.findings = []
+        self.LOG = pd.DataFrame(columns = ['Description', 'Location', 'Row', 'Value', 'Details'])
 
-    def append_LOG(self, description, location):
+    def append_LOG(self, description, location, row='', value='', details=''):
         """Add a line to the error log describing the issue with Master Reference."""
-        temp = pd.DataFrame()
-        temp['Description'] = [description]
-        temp['Location'] = [location]
-        self.LOG = self.LOG.append(temp)
+        self.findings.append((description, location, row, value, details))
+
+    def append_rows_to_LOG(self, description, location, sheet, mask, column):
+        """Adds one log line per row flagged by mask. Row is the row number as seen in Excel (header is row 1)."""
+        rows = sheet[mask.values]
+        row_numbers = (mask.values.nonzero()[0] + 2).tolist()
+        details = ['; '.join(f'{c}={v}' for c, v in zip(rows.columns, values)) for values in rows.itertuples(index=False)]
+        for row, value, detail in zip(row_numbers, rows[column].tolist(), details):
+            self.append_LOG(description, location, row, '' if pd.isna(value) else value, detail)
 
     def check_for_duplicates(self, column):
         """Check to see if column contains duplicates."""
-        def id_duplicate(l):
-            duplicates = [str(i) for i in l if l.count(i)>1]
-            return ' '.join(list(set(duplicates)))
-        if len(self.customer_list[column].unique()) != len(list(self.customer_list[column])):
-            duplicates = id_duplicate(list(self.customer_list[column]))
-            self.append_LOG(f'Duplicate Values in {column}', 'CustomerList, MasterReference')
-            self.append_LOG(f'--->{column} duplicates are:', duplicates)
+        values = self.customer_list[column]
+        duplicates = values.duplicated(keep=False) & values.notna()
+        if duplicates.any():
+            self.append_rows_to_LOG(f'Duplicate Values in {column}', 'CustomerList, MasterReference', self.customer_list, duplicates, column)
             return False
         else:
             return True
 
     def check_for_missing(self, column):
         """Check to see if column contains any NaN"""
-        nulls = self.customer_list[column].isnull().values.any()
-        if nulls:
-            self.append_LOG(f'Missing Values in {column}', 'CustomerList, MasterReference')
+        nulls = self.customer_list[column].isnull()
+        if nulls.any():
+            self.append_rows_to_LOG(f'Missing Values in {column}', 'CustomerList, MasterReference', self.customer_list, nulls, column)
             return False
         else:
             return True
 
     def all_prices_present(self):
         """Check to see if price reference chart is fully filled out."""
-        nulls = self.price_reference['Retail'].isnull().values.any()    
-        if nulls:
-            self.append_LOG('Missing Values', 'PriceSheet, MasterReference')
+        nulls = self.price_reference['Retail'].isnull()
+        if nulls.any():
+            self.append_rows_to_LOG('Missing Values in Retail', 'PriceSheet, MasterReference', self.price_reference, nulls, 'UPC')
             return False
         else:
             return True 
+
+    def all_rules_valid(self):
+        """Check that every row of the optional PriceRules/DiscountRules sheets has its price/rate. Rows without one would be ignored."""
+        passed = True
+        for sheet_name, (_, _, value) in RULE_SHEETS.items():
+            sheet = self.rule_sheets.get(sheet_name)
+            if sheet is None:
+                continue
+            if value not in sheet.columns:
+                self.append_LOG(f'Missing column {value}', f'{sheet_name}, MasterReference')
+                passed = False
+                continue
+            invalid = pd.to_numeric(sheet[value], errors='coerce').isna()
+            if invalid.any():
+                self.append_rows_to_LOG(f'Missing or non numeric {value}', f'{sheet_name}, MasterReference', sheet, invalid, value)
+                passed = False
+        return passed
+
+    def all_invoice_UPCs_priced(self, raw_invoice_path, raw=None):
+        """Check that every Barcode in a raw invoice exists in the PriceSheet, so generation doesn't stop halfway through. raw is the invoice if it's already read."""
+        if raw is None:
+            raw = pd.read_csv(raw_invoice_path, usecols=['DropShipNo', 'Barcode'])
+        raw = raw[(raw['DropShipNo']!=0).fillna(True).values] # Pivotal discount rows aren't priced
+        known_UPCs = ReferenceIndex.upc_keys(self.price_reference['UPC']).dropna().unique()
+        unknown = ~ReferenceIndex.upc_keys(raw['Barcode']).isin(known_UPCs)
+        if unknown.any():
+            raw = raw[unknown.values]
+            #Rows in the csv start at 2 because of the header
+            rows_by_UPC = (raw.index.to_series() + 2).astype(str).groupby(raw['Barcode'].astype(str).values, sort=False).agg(', '.join)
+            for upc, rows in rows_by_UPC.items():
+                self.append_LOG('Barcode not found in PriceSheet', os.path.basename(raw_invoice_path), rows, upc)
+            return False
+        else:
+            return True
         
-    def run_check(self):
-        """Run full suite of checks for reference sheet. """
+    def run_check(self, raw_invoice_paths=(), raw_invoices=None):
+        """Run full suite of checks for reference sheet, plus the Barcode check for any raw invoices about to be generated (raw_invoices: {path: frame} of those already read)."""
         check_1 = self.check_for_duplicates('PLN Stock Lens Account Number')
         check_2 = self.check_for_duplicates('Pivotal Account No.')
         check_3 = self.check_for_missing('PLN Stock Lens Account Number')
         check_4 = self.check_for_missing('Pivotal Account No.')
         check_5 = self.all_prices_present()
-        all_checks  = [check_1, check_2, check_3, check_4, check_5]
-        if False in all_checks:
+        check_6 = self.all_rules_valid()
+        raw_invoices = raw_invoices or {}
+        invoice_checks = [self.all_invoice_UPCs_priced(raw_invoice_path, raw_invoices.get(raw_invoice_path)) for raw_invoice_path in raw_invoice_paths]
+        all_checks  = [check_1, check_2, check_3, check_4, check_5, check_6] + invoice_checks
+        self.LOG = pd.DataFrame(self.findings, columns = self.LOG.columns)
+        self.Passed = False not in all_checks
+        if not self.Passed:
             self.LOG.to_csv(os.path.join(self.current_location, 'REFERENCE_ERROR.csv'), index=False)
             return False
         else:
             return True
 
 class ReportGenerator:
-    def __init__(self):
-        """Handles all the file locations. Note: This script will only work with files in the same directory as it."""
+    def __init__(self, streaming=False, chunksize=STREAMING_CHUNKSIZE, raw_invoice_path='', reference=None, output_format='xlsx', row_limit=None, current_path='', report=None, incremental=False, profile=None, raw_invoice=None):
+        """
+        Handles all the file locations. Note: This script will only work with files in the same directory as it.
+        With streaming=True the raw invoice isn't loaded up front; generate_csv reads it chunksize rows at a time instead.
+        raw_invoice_path picks a specific month (batch runs), reference is the run's ReferenceContext so the Master Reference isn't read again.
+        raw_invoice is the raw invoice's frame if it's already read (main prefetches it with RunIO).
+        output_format is 'xlsx' (the workbook), 'csv' (a folder of csv files, one per sheet) or 'both'. Import sheets are split every row_limit rows (default: the profile's).
+        current_path is the folder holding MasterReference, Input and Output (default: next to the program).
+        profile is the SupplierProfile of the raw invoice (default: the one of the run folder's profiles that matches its file name).
+        report is the RunReport every stage is timed into (main passes the run's report).
+        With incremental=True the invoice is treated as a partial drop and added to the month to date state (see generate_csv_incremental).
+        """
         #self.current_location = os.path.dirname(os.path.abspath(__file__)) #use this line for local development
-        self.current_location = os.path.dirname(sys.executable)
+        self.current_location = current_path or os.path.dirname(sys.executable)
+        self.report = report if report is not None else RunReport()
         self.LensImport = None
         self.ShippingImport = None
         self.DiscountImport = None
@@ -91,123 +217,150 @@ class ReportGenerator:
         self.SummarySheet = None
         self.SummaryOverviewSheet = None
         self.TaxSheet = None
-        self.invoice_number_counter = 1
+        self.CustomerTotals = None
+        self.totals = InvoiceTotals()
+        self.invoice_sequence = InvoiceSequence(self.current_location)
         self.invoice_Found = False
-        self.SOMO_Disc = 0
-        reference_path = os.path.join(self.current_location, 'MasterReference.xlsx')
-        self.customer_list = pd.read_excel(reference_path, sheet_name='CustomerList', engine='openpyxl')
-        self.price_reference = pd.read_excel(reference_path, sheet_name='PriceSheet', engine='openpyxl')
+        self.streaming = streaming
+        self.chunksize = chunksize
+        self.incremental = incremental
+        self.output_format = output_format
+        if reference is None:
+            reference = ReferenceContext(os.path.join(self.current_location, 'MasterReference.xlsx'))
+        self.reference = reference
+        self.customer_list = reference.customer_list
+        self.price_reference = reference.price_reference
         self.save_location = os.path.join(self.current_location, 'Output')
-        self.raw_invoice_path = self.get_raw_invoice()
-        self.raw_invoice = pd.read_csv(self.raw_invoice_path)
-        self.check_missing_DropShipNo()
-        self.create_customer_suffix_key()
+        self.profiles = load_profiles(self.current_location) if profile is None else [profile]
+        self.raw_invoice_path = raw_invoice_path if raw_invoice_path else self.get_raw_invoice()
+        self.profile = profile if profile is not None else find_profile(self.raw_invoice_path, self.profiles)
+        self.row_limit = row_limit or self.profile.row_limit
+        self.invoice_Found = bool(self.raw_invoice_path)
+        self.raw_invoice = None
+        self.missing_PONos = []
+        if not (self.streaming or self.incremental):
+            if raw_invoice is None:
+                with self.stage('read_raw_invoice') as record:
+                    raw_invoice = read_raw_invoice(self.raw_invoice_path)
+                    record['rows_out'] = raw_invoice.shape[0]
+            self.raw_invoice = raw_invoice
+            self.check_missing_DropShipNo()
+        with self.stage('build_reference_index', self.customer_list.shape[0] + self.price_reference.shape[0]):
+            self.create_customer_suffix_key()
+            self.reference_index = self.reference.get_index(self.profile).for_run()
+            self.rules = self.reference.get_rules()
         self.now =self.get_month_of_invoice()
 
+    def stage(self, name, rows_in=None):
+        """Times a block as a stage of this invoice in the run report."""
+        return self.report.stage(name, rows_in, os.path.basename(self.raw_invoice_path))
+
+    def run_stage(self, name, step, rows_in=None, rows_out=None):
+        """
+        Runs step() as a stage of the run report. rows_out is called afterwards to count what the stage produced.
+        rows_in may be a function too, for stages scheduled before their input exists.
+        """
+        with self.stage(name, rows_in() if callable(rows_in) else rows_in) as record:
+            result = step()
+            if rows_out is not None:
+                record['rows_out'] = rows_out()
+        return result
+
     def check_missing_DropShipNo(self):
-        missings = self.raw_invoice[self.raw_invoice['DropShipNo'].isna()]
-        if not missings.empty:
-            missings_str = ', '.join(list(missings['PONo'].astype('str')))
-            self.error_popup(f'Missing values PONo {missings_str}')
+        self.report_missing_DropShipNo(self.find_missing_DropShipNo(self.raw_invoice))
+
+    def find_missing_DropShipNo(self, raw):
+        """Returns the PONo of every row without a DropShipNo."""
+        return list(raw.loc[raw['DropShipNo'].isna(), 'PONo'].astype('str'))
+
+    def report_missing_DropShipNo(self, missing_PONos):
+        """Records rows without a DropShipNo. They can't be billed to a customer, so report_missing_keys reports them and stops the run."""
+        self.missing_PONos.extend(missing_PONos)
 
     def get_raw_invoice(self):
         """Searches the input folder for a raw invoice."""
-        input_path = os.path.join(self.current_location, 'Input')
-        input_files = os.listdir(input_path)
-        raw_pattern = 'H00241'
-        for input_file in input_files:
-            if re.search(raw_pattern, input_file):
-                self.invoice_Found = True
-                return os.path.join(input_path, input_file)
-            else:
-                pass
-        return ''
-
-    def error_report(self, _msg, location):
-        self.error_popup(_msg)
-        self.LOG = pd.DataFrame()
-        self.LOG['Description'] = [_msg]
-        self.LOG['Location'] = [location]
+        raw_invoices = find_raw_invoices(os.path.join(self.current_location, 'Input'), self.profiles)
+        return raw_invoices[0] if raw_invoices else ''
+
+    def report_missing_keys(self):
+        """
+        Reports every raw invoice row without a DropShipNo and every DropShipNo and Barcode missing from the Master Reference
+        in a single error. Returns True if any were found.
+        """
+        findings = self.reference_index.missing_report()
+        if self.missing_PONos:
+            findings.insert(0, (f'Missing values PONo {", ".join(self.missing_PONos)}', os.path.basename(self.raw_invoice_path)))
+        if not findings:
+            return False
+        self.error_popup('\n'.join([description for description, _ in findings]))
+        self.LOG = pd.DataFrame(findings, columns=['Description', 'Location'])
         self.LOG.to_csv(os.path.join(self.current_location, 'ERROR_DETAILS.csv'), index=False)
+        return True
 
     def error_popup(self, msg):
-        """Super simple pop-up to indicate an error has occured."""
-        popup = tk.Tk()
-        popup.wm_title("!")
-        label = tk.Label(popup, text=msg)
-        label.pack(side="top", fill="x", pady=10)
-        B1 = tk.Button(popup, text="Okay", command = popup.destroy)
-        B1.pack()
-        popup.mainloop()
+        """Logs the error, with a pop-up unless the run is non interactive (see ErrorLogging)."""
+        error_popup(msg)
 
     def create_customer_suffix_key(self):
-        """Strips the Full Account Number down to the suffix. This is used by the supplier to ID customers."""
-        def get_suffix_num(account_num):
-            return account_num[-5:].replace('-', '').lstrip('0')
-        self.customer_list['SuffixNum'] = self.customer_list['PLN Stock Lens Account Number'].apply(lambda x: get_suffix_num(x))
+        """
+        Narrows customer_list to the supplier's customers, with the Full Account Number stripped down to the suffix (H00241-00252 -> 252)
+        as SuffixNum. This is used by the supplier to ID customers (DropShipNo). See SupplierProfile.select_customers.
+        """
+        self.customer_list = self.reference.get_customers(self.profile)
 
     def get_month_of_invoice(self):
         """Get which month this invoice is for."""
-        months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
-        year_pattern = "2\\d\\d\\d"
-        for m in months:
-            if re.search(m, self.raw_invoice_path):
-                this_month = months.index(m)+1
-            this_year = int(re.findall(year_pattern, self.raw_invoice_path)[0])
-        return date(this_year, this_month, 1)
+        return invoice_month(self.raw_invoice_path, self.raw_invoice)
 
     def create_output_name(self):
-        """Creates a filename in the format of 'Invoice Import 1 (Mmm YYYY).xlsx'"""
+        """Creates a filename in the format of 'Invoice Import 1 (Mmm YYYY).xlsx' ('Invoice Import 1' is the profile's output_name)"""
         this_year = str(self.now.year)
         this_month = month_name[self.now.month][:3]
-        return f'Invoice Import 1 ({this_month} {this_year}).xlsx'
-
-    def get_Dropship(self, suffix_num):
-        if self.customer_list[self.customer_list['SuffixNum']==str(suffix_num)].empty:
-            self.error_report(f'Customer number (DropShipNo) {suffix_num} not found in Customer list', 'MasterReference, Customer List')
-        return self.customer_list[self.customer_list['SuffixNum']==str(suffix_num)]['PLN Stock Lens Account Number'].iloc[0]
-
-    def get_Pivotal_Account(self, suffix_num):
-        suffix_num = int(suffix_num)
-        if self.customer_list[self.customer_list['SuffixNum']==str(suffix_num)].empty:
-            self.error_report(f'Customer number {suffix_num} not found in Customer list', 'MasterReference, Customer List')
-        return self.customer_list[self.customer_list['SuffixNum']==str(suffix_num)]['Pivotal Account No.'].iloc[0]
-    
-    def get_New_Unit_Price(self, upc):
-        """Sets new price based on Barcode"""
-        upc = int(upc)
-        if self.price_reference[self.price_reference['UPC']==upc].empty:
-            self.error_report(f'Barcode {upc} not found in Price Sheet', 'MasterReference, PriceSheet ')
-        return self.price_reference[self.price_reference['UPC']==upc]['Retail'].iloc[0]
-
-    def get_Category_Name(self, upc):
-        """Sets category name based on Barcode"""
-        upc = int(upc)
-        if self.price_reference[self.price_reference['UPC']==upc].empty:
-            self.error_report(f'Barcode {upc} not found in Price Sheet', 'MasterReference, PriceSheet ')
-        return self.price_reference[self.price_reference['UPC']==upc]['Lens'].iloc[0]
-        
-            
-    def get_sum_ShipAmount(self, customers):
-        values = []
-        for customer in customers:
-            values.append(self.LensImport[self.LensImport['Pivotal Account']==customer]['ShipAmount'].sum())
-        return values
-
-    def get_sum_NewShipAmount(self, customers):
-        values = []
-        for customer in customers:
-            values.append(self.LensImport[self.LensImport['Pivotal Account']==customer]['NewShipAmount'].sum())
-        return values
-
-    def get_sum_Freight(self, customers):
-        values = []
-        for customer in customers:   
-            values.append(self.ShippingImport[self.ShippingImport['Pivotal Account']==str(customer)]['Freight'].sum())
-        return values
+        return f'{self.profile.output_name} ({this_month} {this_year}).xlsx'
+
+    def get_Pivotal_Accounts(self, dropship_nos):
+        """Pivotal Account of every DropShipNo in a column."""
+        return self.reference_index.lookup_customers(dropship_nos, ['Pivotal Account No.'])['Pivotal Account No.']
+
+    def enrich_raw_invoice(self):
+        """
+        Resolves Dropship, Pivotal Account, NewUnit$ and Category for every row of the raw invoice in one pass.
+        The sheet generators only project and filter the enriched rows, so no key is looked up more than once.
+        """
+        self.raw_invoice = self.enrich(self.raw_invoice)
+
+    def enrich(self, raw):
+        """Adds the Master Reference columns to a frame of raw invoice rows. NewUnit$ is the PriceSheet Retail unless a PriceRule applies."""
+        customers = self.reference_index.lookup_customers(raw['DropShipNo'], ['PLN Stock Lens Account Number', 'Pivotal Account No.'])
+        prices = self.reference_index.lookup_prices(raw['Barcode'], ['Retail', 'Lens'])
+        enriched = raw.assign(**{
+            'Dropship': customers['PLN Stock Lens Account Number'],
+            'Pivotal Account': customers['Pivotal Account No.'],
+            'NewUnit$': prices['Retail'],
+            'Category': prices['Lens'],
+        })
+        if self.rules.price_rules is not None:
+            enriched['NewUnit$'] = self.rules.unit_prices(enriched, enriched['NewUnit$'])
+        return enriched
+
+    def aggregate_customer_totals(self, returns=True):
+        """
+        Builds the per Pivotal Account totals (ShipAmount, NewShipAmount, Freight, Discount, Tax) from self.totals (an InvoiceTotals).
+        Discount is 0 until the Discount Import has been generated. returns=False leaves the returns out (Summary Details).
+        """
+        self.CustomerTotals = self.totals.customer_totals(self.DiscountImport, returns)
+        return self.CustomerTotals
+
+    def get_customer_totals(self, customers, column):
+        """Looks up one column of CustomerTotals for a list of Pivotal Accounts. Customers without rows get 0."""
+        return self.CustomerTotals[column].reindex(customers, fill_value=0).values
 
 
     def generate_Lens_Import(self):
+        """Builds the Lens Import sheet from the enriched raw invoice."""
+        self.LensImport = self.build_Lens_Import(self.raw_invoice)
+
+    def build_Lens_Import(self, temp):
         """
         Due Date = 'Net 15'
         To Be emailed = False
@@ -226,36 +379,38 @@ class ReportGenerator:
         NewShipAmount = ShipQty * NewUnit$
         """
         df = pd.DataFrame()
-        length = self.raw_invoice.shape[0]
-        df['Due Date'] = ['Net 15'] * length
-        df['To Be emailed'] = [False] * length
-        df['Print Later'] = [False] * length
-        df['Dropship'] = self.raw_invoice['DropShipNo'].apply(lambda x: self.get_Dropship(x))
-        df['Pivotal Account'] = self.raw_invoice['DropShipNo'].apply(lambda x: self.get_Pivotal_Account(x))
-        df['DropShipNo'] = self.raw_invoice['DropShipNo']
-        df['OrderID'] = self.raw_invoice['OrderID']
-        df['ShipDate'] =self.raw_invoice['ShipDate']
-        df['Item'] = ['SOMO Stock'] * length 
-        df['ItemName'] = self.raw_invoice['ItemName']
-        df['ShipQty'] = self.raw_invoice['ShipQty']
-        df['UnitPrice'] = self.raw_invoice['UnitPrice']
-        df['ShipAmount'] = self.raw_invoice['ShipAmount']
-        df['NewUnit$'] = self.raw_invoice['Barcode'].apply(lambda x: self.get_New_Unit_Price(x))
+        length = temp.shape[0]
+        df['Due Date'] = constant_column(self.profile.terms, length)
+        df['To Be emailed'] = constant_column(False, length)
+        df['Print Later'] = constant_column(False, length)
+        df['Dropship'] = temp['Dropship'].values
+        df['Pivotal Account'] = temp['Pivotal Account'].values
+        df['DropShipNo'] = customer_keys(temp['DropShipNo']).values
+        df['OrderID'] = temp['OrderID'].values
+        df['ShipDate'] =temp['ShipDate'].values
+        df['Item'] = constant_column('SOMO Stock', length)
+        df['ItemName'] = temp['ItemName'].values
+        df['ShipQty'] = temp['ShipQty'].values
+        df['UnitPrice'] = temp['UnitPrice'].values
+        df['ShipAmount'] = temp['ShipAmount'].values
+        df['NewUnit$'] = temp['NewUnit$'].values
         df['NewShipAmount'] = df['ShipQty'] * df['NewUnit$']
         df['ShipAmount'] = df['ShipAmount'].astype('float32')
         # df['NewShipAmount'] = df['NewShipAmount'].astype('float32')
-        df['UPC'] = self.raw_invoice['Barcode']    
-        df['Category'] = self.raw_invoice['Barcode'].apply(lambda x: self.get_Category_Name(x))  
+        df['UPC'] = temp['Barcode'].values
+        df['Category'] = temp['Category'].values
         
         #Custom Formatting
         df['NewUnit$'] = df['NewUnit$'].round(2)
         df['NewShipAmount'] = df['NewShipAmount'].round(2)
         df['UPC'] = df['UPC'].astype(str).str.zfill(10)
-    
-        self.LensImport = df
+        return df
 
-    
     def generate_Shipping_Import(self):
+        """Builds the Shipping Import sheet from the enriched raw invoice."""
+        self.ShippingImport = self.build_Shipping_Import(self.raw_invoice)
+    
+    def build_Shipping_Import(self, raw):
         """
         Pivotal Account = /d/d/d/d/dA; get from lookup from Dropship
         Due Date = 'Net 15'
@@ -270,82 +425,97 @@ class ReportGenerator:
 
         Special Note: in Shipping Import tab only display where Freight is NOT zero.
         """
+        temp = raw[raw['Freight'].round(2)!=0]
         df = pd.DataFrame()
-        length = self.raw_invoice.shape[0]
-        df['Pivotal Account'] = self.raw_invoice['DropShipNo'].apply(lambda x: self.get_Pivotal_Account(x))
-        df['Due Date'] = ['Net 15'] * length
-        df['To Be emailed'] = [False] * length
-        df['Print Later'] = [False] * length
-        df['Dropship'] = self.raw_invoice['DropShipNo'].apply(lambda x: self.get_Dropship(x))
-        df['OrderID'] = self.raw_invoice['OrderID']
-        df['ShipDate'] =self.raw_invoice['ShipDate']
-        df['Item'] = ['Shipping']*length
-        df['ShipVia'] = self.raw_invoice['ShipVia']
-        df['Freight'] = self.raw_invoice['Freight']
+        length = temp.shape[0]
+        df['Pivotal Account'] = temp['Pivotal Account'].values
+        df['Due Date'] = constant_column(self.profile.terms, length)
+        df['To Be emailed'] = constant_column(False, length)
+        df['Print Later'] = constant_column(False, length)
+        df['Dropship'] = temp['Dropship'].values
+        df['OrderID'] = temp['OrderID'].values
+        df['ShipDate'] =temp['ShipDate'].values
+        df['Item'] = constant_column('Shipping', length)
+        df['ShipVia'] = temp['ShipVia'].values
+        df['Freight'] = temp['Freight'].values
         df['Freight'] = df['Freight'].round(2)
-
-        df = df[df['Freight']!=0]
-        self.ShippingImport = df
+        return df
 
     def generate_Discount_Import(self):
+        """Builds the Discount Import sheet from the Lens Import (returns included)."""
+        self.LensImport = self.LensImport[self.LensImport.DropShipNo.notna()]
+        self.totals.add_sheets(self.LensImport, self.ShippingImport, self.TaxSheet)
+        self.aggregate_customer_totals()
+        self.DiscountImport = self.build_Discount_Import(list(self.LensImport['DropShipNo'].unique()), self.discount_category_totals())
+
+    def discount_category_totals(self):
+        """NewShipAmount per Pivotal Account and Category, for DiscountRules (None without them)."""
+        if self.rules.discount_rules is None:
+            return None
+        return self.totals.category_totals()
+
+    def build_Discount_Import(self, all_customers, category_totals=None):
         """
+        all_customers are the DropShipNo of this month's customers in order of appearance, totals come from CustomerTotals.
+        category_totals (NewShipAmount per Pivotal Account and Category) are only needed for DiscountRules (see PricingRules.discounts).
+        A customer is listed if it has the profile's discount or a DiscountRule gives it one.
+
         Pivotal Account No. = /d/d/d/d/dA; get from lookup from Dropship
         Due Date = 'Net 15'
         To Be emailed = False
         Print Later = False
         Item = 'Stock Discount'
-        Invoice # = TBD; Wants a unique invoice number - rough D{MMDDYY}seqint
-        Description = '5% Legacy Discount'
+        Invoice # = D{MMYY}{last day of the month}{sequence number}, a block of the month's InvoiceSequence so reruns never reuse a number
+        Description = '5% Legacy Discount' (the profile's discount_description)
         Invoice Date = last date of the current month
         ShipAmount = sum of all supplier prices from one customer; get from Lens Import
         NewShipAmount = sum of all retail prices from one customer; get from Lens Import
-        Discount = NewShipAmount * .05
+        Discount = NewShipAmount * .05 (the profile's discount_rate, for customers with Yes in its discount_column, or the DiscountRules rates)
         Total Amount Owed = NewShipAmount - Discount
 
         Special Notes: only show non zeros, copy most from Lens Import
         """
-        def generate_invoice_number():
-            monthnum = str(self.now.month)
-            if len(monthnum)<2:
-                monthnum = '0' + monthnum
-            yearnum  =str(self.now.year)[-2:]
-            finalday = str(monthrange(self.now.year, self.now.month)[1])
-            finaldigit = str(self.invoice_number_counter)
-            while len(finaldigit)<4:
-                finaldigit = '0' + finaldigit
-            self.invoice_number_counter+=1
-            return 'D'+monthnum+yearnum+finalday+finaldigit
-        self.LensImport = self.LensImport[self.LensImport.DropShipNo.notna()]
-        self.LensImport['DropShipNo'] = self.LensImport['DropShipNo'].apply(lambda x: str(int(x)) if isinstance(x, float) else x)
-        #TODO prolly the spot to fix this
-        discount_customer_list = self.customer_list[self.customer_list['Stock Lens 5% Discount']=='Yes']
-        discount_customers = list(discount_customer_list['SuffixNum'].unique())
-        all_customers = list(self.LensImport['DropShipNo'].unique())
-
-        # all_customers = [str(int(c)) if isinstance(c, float) else c for c in all_customers]
-
-        customers = [str(i) for i in all_customers if str(i) in discount_customers]
+        discount_customer_list = self.customer_list[self.customer_list[self.profile.discount_column]=='Yes']
+        discount_customers = set(discount_customer_list['SuffixNum'].dropna())
+        invoice_date = date(self.now.year, self.now.month, monthrange(self.now.year, self.now.month)[1])
+        flagged = np.array([i in discount_customers for i in all_customers], dtype=bool)
+        pivotal_accounts = list(self.get_Pivotal_Accounts(all_customers))
+        discounts = self.rules.discounts(pivotal_accounts, np.where(flagged, self.profile.discount_rate, 0.0), self.CustomerTotals['NewShipAmount'], category_totals, invoice_date)
+        listed = flagged | (discounts != 0)
+        customers = [customer for customer, is_listed in zip(pivotal_accounts, listed) if is_listed]
         length = len(customers)
-        customers = [self.get_Pivotal_Account(i) for i in customers]
         df = pd.DataFrame()
         df['Pivotal Account No.'] = customers
-        df['Due Date'] = ['Net 15'] * length
-        df['To Be emailed'] = [False] * length
-        df['Print Later'] = [False] * length
-        df['Item'] = ['Stock Discount']*length
-        df['Invoice #'] = [generate_invoice_number() for i in range(length)]
-        df['Description'] = [r'5% Legacy Discount'] * length
-        df['Invoice Date'] = [date(self.now.year, self.now.month, monthrange(self.now.year, self.now.month)[1])] * length
-        df['ShipAmount'] = self.get_sum_ShipAmount(customers)
-        df['NewShipAmount'] = self.get_sum_NewShipAmount(customers)
-        df['Discount'] =  df['NewShipAmount']*.05
+        df['Due Date'] = constant_column(self.profile.terms, length)
+        df['To Be emailed'] = constant_column(False, length)
+        df['Print Later'] = constant_column(False, length)
+        df['Item'] = constant_column('Stock Discount', length)
+        df['Invoice #'] = self.invoice_numbers(length)
+        df['Description'] = constant_column(self.profile.discount_description, length)
+        df['Invoice Date'] = constant_column(invoice_date, length)
+        df['ShipAmount'] = self.get_customer_totals(customers, 'ShipAmount')
+        df['NewShipAmount'] = self.get_customer_totals(customers, 'NewShipAmount')
+        df['Discount'] =  discounts[listed]
         df['Discount'] = df['Discount'].apply(lambda x: round(x, 2))
         df['Discount'] = df['Discount'].round(2)
         df['Total Amount Owed'] = round(df['NewShipAmount']-df['Discount'], 2)
-        self.DiscountImport = df
+        return df
     
+    def invoice_numbers(self, count):
+        """count new invoice numbers of this month, from invoice_sequence (numbered from 1 without one, e.g. when backfilling history)."""
+        if self.invoice_sequence is None:
+            return format_invoice_numbers(self.now, 1, count)
+        return self.invoice_sequence.invoice_numbers(self.now, count)
+
     def generate_Summary_Sheet(self):
+        """Builds the Summary Details sheet from the Lens Import (returns removed)."""
+        self.aggregate_customer_totals(returns=False)
+        self.SummarySheet = self.build_Summary_Sheet(list(self.LensImport['DropShipNo'].unique()))
+
+    def build_Summary_Sheet(self, this_months_customers):
         """
+        this_months_customers are the DropShipNo of this month's customers in order of appearance, totals come from CustomerTotals.
+
         Pivotal #
         Freight = Freight
         ShipAmount = Total supplier amount for each customer
@@ -353,26 +523,26 @@ class ReportGenerator:
         Discount = Discount from Discount Import for relevant customers
         Total Charged = Freight + NewShipAmount - Discount
         """
-        this_months_customers = list(self.LensImport['DropShipNo'].unique())
-        all_customers = list(self.customer_list['SuffixNum'].unique())
-        customers_who_didnt_purchase = [str(i) for i in all_customers if str(i) not in this_months_customers]
-        customer_by_pivotal_account_no = [self.get_Pivotal_Account(i) for i in this_months_customers]
+        all_customers = list(self.customer_list['SuffixNum'].dropna().unique())
+        purchased = set(this_months_customers)
+        customers_who_didnt_purchase = [i for i in all_customers if i not in purchased]
+        customer_by_pivotal_account_no = list(self.get_Pivotal_Accounts(this_months_customers))
         df = pd.DataFrame()
         df['Pivotal #'] = customer_by_pivotal_account_no
         df['DropShipNo'] = this_months_customers
-        df['Freight']  = self.get_sum_Freight(customer_by_pivotal_account_no)
-        df['ShipAmount'] = self.get_sum_ShipAmount(customer_by_pivotal_account_no)
-        df['NewShipAmount'] = self.get_sum_NewShipAmount(customer_by_pivotal_account_no)
-        df['Discount'] = [self.DiscountImport[self.DiscountImport['Pivotal Account No.']==i]['Discount'].sum() for i in customer_by_pivotal_account_no]
+        df['Freight']  = self.get_customer_totals(customer_by_pivotal_account_no, 'Freight')
+        df['ShipAmount'] = self.get_customer_totals(customer_by_pivotal_account_no, 'ShipAmount')
+        df['NewShipAmount'] = self.get_customer_totals(customer_by_pivotal_account_no, 'NewShipAmount')
+        df['Discount'] = self.get_customer_totals(customer_by_pivotal_account_no, 'Discount')
         df['Total Charged'] = round(df['Freight'] + df['NewShipAmount'] - df['Discount'], 2)
         temp = pd.DataFrame()
-        temp['Pivotal #'] = [self.get_Pivotal_Account(i) for i in customers_who_didnt_purchase]
-        temp['DropShipNo'] = [int(i) for i in customers_who_didnt_purchase]
+        temp['Pivotal #'] = list(self.get_Pivotal_Accounts(customers_who_didnt_purchase))
+        temp['DropShipNo'] = customer_keys(customers_who_didnt_purchase).values
         
         df = pd.concat([df, temp], ignore_index=True)
         #Custom function - sort
         df = df.sort_values(by='Pivotal #')
-        self.SummarySheet = df
+        return df
 
     def generate_Summary_Overview(self):
         # df = pd.DataFrame()
@@ -393,7 +563,7 @@ class ReportGenerator:
         df = pd.DataFrame()
         df['Description'] = ['Retail Lens Invoiced', 
                              'Shipping Costs', 
-                             'Retail 5% Discount', 
+                             self.profile.discount_label(), 
                              'Total Invoiced', 
                              '',
                              '',
@@ -408,22 +578,25 @@ class ReportGenerator:
                              '',
                              '',
                              'Net Profit']
-        total_invoiced = self.SummarySheet['NewShipAmount'].sum() + self.SummarySheet['Freight'].sum() - self.SummarySheet['Discount'].sum()
-        total_cost = self.SummarySheet['ShipAmount'].sum()+self.SOMO_Disc + self.SummarySheet['Freight'].sum()+self.TaxSheet['NewShipAmount'].sum()
-        net_profit = total_invoiced-total_cost+self.LensReturnsCredits['NewShipAmount'].sum()
-        df['Value'] = [self.SummarySheet['NewShipAmount'].sum(),
-                       self.SummarySheet['Freight'].sum(),
-                       self.SummarySheet['Discount'].sum(),
+        #Every figure is an exact sum in cents (see InvoiceTotals), so it's the same whichever way the month was generated
+        retail, freight, discount, pivotal = [money_sum(self.SummarySheet[column]) for column in ['NewShipAmount', 'Freight', 'Discount', 'ShipAmount']]
+        somo_disc, tax, return_credits = self.totals.somo_disc_total(), self.totals.tax_total(), self.totals.returns_total()
+        total_invoiced = money_sum([retail, freight, -discount])
+        total_cost = money_sum([pivotal, somo_disc, freight, tax])
+        net_profit = money_sum([total_invoiced, -total_cost, return_credits])
+        df['Value'] = [retail,
+                       freight,
+                       discount,
                        total_invoiced,
                        '',
                        '',
                        '',
-                       self.SummarySheet['ShipAmount'].sum(),
-                       self.SOMO_Disc, 
-                       self.SummarySheet['Freight'].sum(),
-                       self.TaxSheet['NewShipAmount'].sum(), #TODO Double check this
+                       pivotal,
+                       somo_disc, 
+                       freight,
+                       tax, #TODO Double check this
                        total_cost, #Total Pivotal Cost
-                       (-1*self.LensReturnsCredits['NewShipAmount'].sum()),
+                       -return_credits,
                        '',
                        '',
                        '',
@@ -434,124 +607,487 @@ class ReportGenerator:
         """
         Generates a sheet covering every negative sale indicating a return amount.
         """
-        df = self.LensImport[self.LensImport['ShipQty']<0].copy()
-        self.LensImport = self.LensImport[self.LensImport['ShipQty']>=0] # Removing negative LensImport ShipQty from Lens Import
-        df['Item'] = ['Rtn Credit'] * df.shape[0]
+        self.LensReturnsCredits, self.LensImport = self.split_returns(self.LensImport)
+
+    def split_returns(self, lens):
+        """Splits Lens Import rows into the Returns Credits sheet and the remaining (non negative ShipQty) Lens Import rows."""
+        df = lens[lens['ShipQty']<0].copy()
+        lens = lens[lens['ShipQty']>=0] # Removing negative LensImport ShipQty from Lens Import
+        df['Item'] = constant_column('Rtn Credit', df.shape[0])
         df['Positive ShipQ'] = df['ShipQty']*-1
         df['Positive New Ship Amount'] = df['NewShipAmount'] *-1
-        self.LensReturnsCredits = df
+        return df, lens
 
     def remove_discount(self):
         """Removes Discount given for Pivotal denoted by DropShipNo 0 for use in the summary"""
-        discount_row = self.raw_invoice[self.raw_invoice['DropShipNo']==0]
-        self.SOMO_Disc = discount_row['TotalAmount'].sum()
-        self.raw_invoice = self.raw_invoice[self.raw_invoice['DropShipNo']!=0]
+        self.raw_invoice = self.split_discount(self.raw_invoice, self.totals)
+
+    @staticmethod
+    def split_discount(raw, totals):
+        """Adds the Pivotal discount rows (DropShipNo 0) to totals (an InvoiceTotals) and returns the remaining raw invoice rows."""
+        is_discount = (raw['DropShipNo']==0).fillna(False).astype(bool)
+        totals.add_discounts(raw.loc[is_discount, 'TotalAmount'])
+        return raw[~is_discount]
 
 
     def archive_inputs(self):
-        """Moves the files in Input to Archive upon completion of the script."""
-        input_path = os.path.join(self.current_location, 'Input')
-        archive_location = os.path.join(self.current_location, 'Archive')
-        input_files = os.listdir(input_path)
-        for input_file in input_files:
-            old_location = os.path.join(input_path, input_file)
-            new_location = os.path.join(archive_location, input_file)
-            os.rename(old_location, new_location)
+        """Moves the files in Input to a run subfolder of Archive upon completion of the script."""
+        archive_inputs(self.current_location)
 
     def divide_Lens_Import(self):
-        """Takes the Lens Import sheet and breaks it into chunks of no more than 5000 rows so that QuickBooks can handle it."""
-        number_of_sheets = self.LensImport.shape[0]//5000 + 1
-        return [[f'Lens Import {i+1}', self.LensImport[i*5000:(i+1)*5000]] for i in range(number_of_sheets)]
+        """Takes the Lens Import sheet and breaks it into chunks of no more than row_limit (5000 by default) rows so that QuickBooks can handle it."""
+        number_of_sheets = self.LensImport.shape[0]//self.row_limit + 1
+        return [[f'Lens Import {i+1}', self.LensImport[i*self.row_limit:(i+1)*self.row_limit]] for i in range(number_of_sheets)]
 
     def generate_Tax_Sheet(self):
-        temp = self.raw_invoice[self.raw_invoice['Tax']!=0].copy()
+        self.TaxSheet = self.build_Tax_Sheet(self.raw_invoice)
+
+    def build_Tax_Sheet(self, raw):
+        temp = raw[raw['Tax']!=0].copy()
         df = pd.DataFrame()
         length = temp.shape[0]
-        df['Due Date'] = ['Net 15'] * length
-        df['To Be emailed'] = [False] * length
-        df['Print Later'] = [False] * length
-        df['Dropship'] = temp['DropShipNo'].values
-        df['Dropship'] = df['Dropship'].apply(lambda x: self.get_Dropship(x))
-        df['Pivotal Account'] = temp['DropShipNo'].values
-        df['Pivotal Account'] = df['Pivotal Account'].apply(lambda x: self.get_Pivotal_Account(x))
-        df['DropShipNo'] = temp['DropShipNo'].values
+        df['Due Date'] = constant_column(self.profile.terms, length)
+        df['To Be emailed'] = constant_column(False, length)
+        df['Print Later'] = constant_column(False, length)
+        df['Dropship'] = temp['Dropship'].values
+        df['Pivotal Account'] = temp['Pivotal Account'].values
+        df['DropShipNo'] = customer_keys(temp['DropShipNo']).values
         df['OrderID'] = temp['OrderID'].values
         df['ShipDate'] =temp['ShipDate'].values
-        df['Item'] = ['SOMO Stock'] * length 
-        df['ItemName'] = ['Tax'] * length
+        df['Item'] = constant_column('SOMO Stock', length)
+        df['ItemName'] = constant_column('Tax', length)
         df['NewShipAmount'] = temp['Tax'].values
         df['NewShipAmount'] = df['NewShipAmount'].round(2)
-        self.TaxSheet = df
-
-    def generate_csv(self):
-        """Full process of generating each sheet then writing it to an excel file."""
-        self.remove_discount()
-        self.generate_Lens_Import()
-        self.generate_Shipping_Import()
-        self.generate_Discount_Import()
-        self.generate_Lens_Returns_Credits()
-        self.generate_Tax_Sheet()
-        self.generate_Summary_Sheet()
-        self.generate_Summary_Overview()
-        output_name = self.create_output_name()
-        writer = pd.ExcelWriter(os.path.join(self.save_location, output_name), engine='xlsxwriter')
+        return df
+
+    def write_Lens_Import(self, writer):
+        """Writes the Lens Import, split into row_limit sized sheets if it's longer than that."""
         list_of_Lens_Import_chunks = self.divide_Lens_Import()
         if len(list_of_Lens_Import_chunks)>1:
             for chunk in list_of_Lens_Import_chunks:
-                chunk[1].to_excel(writer, index=False, sheet_name=chunk[0])
+                writer.write_sheet(chunk[1], chunk[0])
         else:
-            self.LensImport.to_excel(writer, index=False, sheet_name='Lens Import')
-        self.TaxSheet.to_excel(writer, index=False, sheet_name='Taxes')
-        self.ShippingImport.to_excel(writer, index=False, sheet_name='Shipping Import')
-        self.DiscountImport.to_excel(writer, index=False, sheet_name='Discount Import')
-        self.LensReturnsCredits.to_excel(writer, index=False, sheet_name='Lens Returns Credits')
-        self.SummarySheet.to_excel(writer, index=False, sheet_name='Summary Details')
-        self.SummaryOverviewSheet.to_excel(writer, index=False, sheet_name='Summary Overview')
-        writer.close()
-        self.archive_inputs()
-
-
-def main(_path = ''):
+            writer.write_sheet(self.LensImport, 'Lens Import')
+
+    def write_report_sheets(self, writer):
+        """Writes every sheet that comes after the Lens Import sheets. Sheets the streaming generator spooled to disk are written chunk by chunk."""
+        for sheet_name, attribute, _ in REPORT_SHEETS:
+            sheet = getattr(self, attribute)
+            if isinstance(sheet, SheetSpool):
+                writer.write_sheet_chunks(sheet, sheet_name, sheet.rows)
+            else:
+                writer.write_sheet(sheet, sheet_name)
+
+    def write_output(self):
+        """Writes the Lens Import sheets and every other sheet in one go, once they are all built."""
+        with self.stage('write_output', self.LensImport.shape[0] + self.count_report_sheet_rows()):
+            output_name = self.create_output_name()
+            writer = open_writer(os.path.join(self.save_location, output_name), self.output_format, self.row_limit)
+            try:
+                self.write_Lens_Import(writer)
+                self.write_report_sheets(writer)
+            except BaseException:
+                writer.discard()
+                raise
+            writer.close()
+
+    def count_report_sheet_rows(self):
+        """Rows written by write_report_sheets, for the run report."""
+        sheets = [getattr(self, attribute) for _, attribute, _ in REPORT_SHEETS]
+        return sum(sheet.rows if isinstance(sheet, SheetSpool) else sheet.shape[0] for sheet in sheets)
+
+    def read_raw_invoice_chunks(self, raw_invoice_path=''):
+        """Reads the raw invoice (default: this run's) chunksize rows at a time with the RAW_INVOICE_DTYPES of InvoiceSchema."""
+        raw_invoice_path = raw_invoice_path or self.raw_invoice_path
+        return pd.read_csv(raw_invoice_path, dtype=raw_invoice_dtypes(raw_invoice_path), chunksize=self.chunksize)
+
+    @staticmethod
+    def concat_sheets(frames):
+        """Concatenates per chunk sheet rows. Empty chunks are skipped so their object columns don't change the sheet dtypes."""
+        frames = [frame for frame in frames if frame is not None]
+        non_empty = [frame for frame in frames if not frame.empty]
+        if len(non_empty) == 1:
+            return non_empty[0]
+        return pd.concat(non_empty or frames[:1], ignore_index=True)
+
+    def accumulate(self, raw, state, history=None):
+        """
+        Enriches raw invoice rows (discount rows already removed) and adds their Shipping, Tax and Returns rows and their
+        customer totals to state (an InvoiceState). Returns their Lens Import rows, returns removed.
+        With history (an InvoiceHistory) every sheet's rows are staged for it too.
+        """
+        raw = self.enrich(raw)
+        shipping = self.build_Shipping_Import(raw)
+        taxes = self.build_Tax_Sheet(raw)
+        lens = self.build_Lens_Import(raw)
+        lens = lens[lens.DropShipNo.notna()]
+        state.all_customers.update(dict.fromkeys(lens['DropShipNo'].unique()))
+        state.totals.add_sheets(lens, shipping, taxes)
+        returns, lens = self.split_returns(lens)
+        state.kept_customers.update(dict.fromkeys(lens['DropShipNo'].unique()))
+        state.shipping.append(shipping)
+        state.taxes.append(taxes)
+        state.returns.append(returns)
+        if history is not None:
+            for table, sheet in [('lens_rows', lens), ('return_rows', returns), ('shipping_rows', shipping), ('tax_rows', taxes)]:
+                history.stage_rows(table, self.now, sheet)
+        return lens
+
+    def build_summaries(self, state):
+        """Builds the Discount and Summary sheets from the customer totals of an InvoiceState."""
+        self.totals = state.totals
+        self.DiscountImport = None
+        self.aggregate_customer_totals()
+        self.DiscountImport = self.build_Discount_Import(list(state.all_customers), self.discount_category_totals())
+        self.aggregate_customer_totals(returns=False)
+        self.SummarySheet = self.build_Summary_Sheet(list(state.kept_customers))
+        self.generate_Summary_Overview()
+
+    def generate_csv_streaming(self, archive=True):
+        """
+        Same workbook as generate_csv, but the raw invoice is read, enriched and aggregated one chunk at a time.
+        Lens Import rows are written straight into the row_limit sized sheets as they fill. The Shipping, Tax and Returns rows,
+        which can only be written after them, are spooled to temporary files (SheetSpool), and the customer totals are
+        added up per chunk in cents (InvoiceTotals), so memory holds a chunk and one row per customer however big the invoice is.
+        Every sheet's rows are staged for the InvoiceHistory chunk by chunk too, and only stored (in one short transaction) if the month is generated.
+        """
+        history = InvoiceHistory(self.current_location, self.profile.history_db)
+        state = InvoiceState(self.now)
+        state.shipping, state.taxes, state.returns = SheetSpool(), SheetSpool(), SheetSpool()
+        try:
+            return self.stream_month(state, history, archive)
+        finally:
+            for spool in [state.shipping, state.taxes, state.returns]:
+                spool.close()
+            history.close()
+
+    def stream_month(self, state, history, archive):
+        writer = open_writer(os.path.join(self.save_location, self.create_output_name()), self.output_format, self.row_limit)
+        written = False
+        try:
+            written = self.stream_sheets(state, history, writer)
+        finally:
+            if not written:
+                writer.discard()
+                history.rollback()
+        if not written:
+            return False
+        self.run_stage('close_output', writer.close)
+        self.run_stage('store_history', lambda: history.store_month(self, [self.raw_invoice_path], staged=True), self.count_report_sheet_rows())
+        if archive:
+            self.run_stage('archive_inputs', self.archive_inputs)
+        return True
+
+    def stream_sheets(self, state, history, writer):
+        """Writes every sheet of the streamed month with writer. Returns False, with the errors reported, if any DropShipNo or Barcode is missing."""
+        missing_PONos = []
+        lens_buffer = None
+        lens_sheet_count = 0
+        with self.stage('process_chunks', 0) as record:
+            for chunk in self.read_raw_invoice_chunks():
+                record['rows_in'] += chunk.shape[0]
+                missing_PONos.extend(self.find_missing_DropShipNo(chunk))
+                chunk = self.split_discount(chunk, state.totals)
+                lens = self.accumulate(chunk, state, history)
+                lens_buffer = self.concat_sheets([lens_buffer, lens])
+                while lens_buffer.shape[0] >= self.row_limit:
+                    lens_sheet_count += 1
+                    writer.write_sheet(lens_buffer[:self.row_limit], f'Lens Import {lens_sheet_count}')
+                    lens_buffer = lens_buffer[self.row_limit:].reset_index(drop=True)
+            record['rows_out'] = lens_sheet_count*self.row_limit + lens_buffer.shape[0]
+        self.report_missing_DropShipNo(missing_PONos)
+        if self.report_missing_keys():
+            return False
+        with self.stage('write_last_Lens_Import', lens_buffer.shape[0]):
+            if lens_sheet_count:
+                writer.write_sheet(lens_buffer, f'Lens Import {lens_sheet_count+1}')
+            else:
+                writer.write_sheet(lens_buffer, 'Lens Import')
+        with self.stage('build_summaries', len(state.all_customers)) as record:
+            self.build_summaries(state)
+            self.ShippingImport, self.TaxSheet, self.LensReturnsCredits = state.shipping, state.taxes, state.returns
+            record['rows_out'] = self.SummarySheet.shape[0]
+        with self.stage('write_report_sheets', self.count_report_sheet_rows()):
+            self.write_report_sheets(writer)
+        return True
+
+    def get_state_path(self):
+        return os.path.join(self.current_location, 'State', f'{self.profile.name} {self.now:%Y-%m}.pkl')
+
+    def find_archived_drops(self):
+        """Raw invoices for this month already in Archive (oldest first), other than the one being run."""
+        drops = [raw_invoice for raw_invoice in find_archived_raw_invoices(self.current_location, [self.profile])
+                 if invoice_month(raw_invoice) == self.now and os.path.basename(raw_invoice) != os.path.basename(self.raw_invoice_path)]
+        return sorted(drops, key=os.path.getmtime)
+
+    def generate_csv_incremental(self, archive=True):
+        """
+        Month to date workbook for suppliers that send the month in partial drops.
+        The rows and totals of the earlier drops come from the month's InvoiceState in State/, so only the new OrderID/Barcode
+        rows of this drop are enriched and added, and the summaries are rebuilt from the running customer totals.
+        Without a saved state, the month's drops already in Archive are processed first. The state is only saved once the
+        workbook is written, so a failed drop can simply be run again. Totals match generate_csv's to the cent.
+        """
+        state_path = self.get_state_path()
+        state = InvoiceState.load(state_path)
+        drops = [self.raw_invoice_path]
+        if state is None:
+            state = InvoiceState(self.now)
+            drops = self.find_archived_drops() + drops
+        if not self.process_drops(state, drops):
+            return False
+        self.write_output()
+        self.run_stage('store_history', lambda: store_history(self, state.files), self.LensImport.shape[0] + self.count_report_sheet_rows())
+        self.run_stage('save_state', lambda: state.save(state_path), len(state.files))
+        if archive:
+            self.run_stage('archive_inputs', self.archive_inputs)
+        return True
+
+    def process_drops(self, state, drops):
+        """
+        Adds the rows of drops (raw invoice paths) not already in state, then builds every sheet from it. The Lens Import is the
+        state's rows so far. Returns False, with the errors reported, if any DropShipNo or Barcode is missing from the Master Reference.
+        """
+        missing_PONos = []
+        with self.stage('process_new_rows', 0) as record:
+            for drop in drops:
+                for chunk in self.read_raw_invoice_chunks(drop):
+                    record['rows_in'] += chunk.shape[0]
+                    chunk = state.take_new_rows(chunk)
+                    missing_PONos.extend(self.find_missing_DropShipNo(chunk))
+                    chunk = self.split_discount(chunk, state.totals)
+                    state.lens.append(self.accumulate(chunk, state))
+                state.finish_file(os.path.basename(drop))
+            self.LensImport = self.concat_sheets(state.lens)
+            self.ShippingImport = self.concat_sheets(state.shipping)
+            self.TaxSheet = self.concat_sheets(state.taxes)
+            self.LensReturnsCredits = self.concat_sheets(state.returns)
+            state.lens, state.shipping, state.taxes, state.returns = [self.LensImport], [self.ShippingImport], [self.TaxSheet], [self.LensReturnsCredits]
+            record['rows_out'] = self.LensImport.shape[0]
+        self.report_missing_DropShipNo(missing_PONos)
+        if self.report_missing_keys():
+            return False
+        with self.stage('build_summaries', len(state.all_customers)) as record:
+            self.build_summaries(state)
+            record['rows_out'] = self.SummarySheet.shape[0]
+        return True
+
+    def schedule_sheets(self, writer):
+        """
+        StageScheduler that builds every sheet from the enriched raw invoice and writes it with writer, each step as soon as its inputs are ready.
+        The Lens, Shipping and Tax sheets are independent of each other. Discount Import needs the whole Lens Import (returns included)
+        and cleans its DropShipNo, then Returns splits the returns off, then Summary and Overview total what's left.
+        Sheets are written one at a time in workbook order (constant_memory workbooks can't go back to an earlier sheet), so
+        the Lens Import sheets are being written while the Summary sheets are still being built.
+        """
+        raw_rows = lambda: self.raw_invoice.shape[0]
+        lens_rows = lambda: self.LensImport.shape[0]
+        scheduler = StageScheduler()
+        def add(name, step, after, rows_in, rows_out=None):
+            scheduler.add(name, lambda: self.run_stage(name, step, rows_in, rows_out), after)
+        add('generate_Lens_Import', self.generate_Lens_Import, [], raw_rows, lens_rows)
+        add('generate_Shipping_Import', self.generate_Shipping_Import, [], raw_rows, lambda: self.ShippingImport.shape[0])
+        add('generate_Tax_Sheet', self.generate_Tax_Sheet, [], raw_rows, lambda: self.TaxSheet.shape[0])
+        add('generate_Discount_Import', self.generate_Discount_Import, ['generate_Lens_Import', 'generate_Shipping_Import', 'generate_Tax_Sheet'], lens_rows, lambda: self.DiscountImport.shape[0])
+        add('generate_Lens_Returns_Credits', self.generate_Lens_Returns_Credits, ['generate_Discount_Import'], lens_rows, lambda: self.LensReturnsCredits.shape[0])
+        add('generate_Summary_Sheet', self.generate_Summary_Sheet, ['generate_Lens_Returns_Credits'], lens_rows, lambda: self.SummarySheet.shape[0])
+        add('generate_Summary_Overview', self.generate_Summary_Overview, ['generate_Summary_Sheet'], lambda: self.SummarySheet.shape[0], lambda: self.SummaryOverviewSheet.shape[0])
+        add('write_Lens_Import', lambda: self.write_Lens_Import(writer), ['generate_Lens_Returns_Credits'], lens_rows)
+        previous = 'write_Lens_Import'
+        for sheet_name, attribute, built_by in REPORT_SHEETS:
+            name = 'write_' + sheet_name.replace(' ', '_')
+            add(name, lambda sheet_name=sheet_name, attribute=attribute: writer.write_sheet(getattr(self, attribute), sheet_name), [previous, built_by],
+                lambda attribute=attribute: getattr(self, attribute).shape[0])
+            previous = name
+        return scheduler
+
+    def generate_csv(self, archive=True):
+        """Full process of generating each sheet then writing it to an excel file. Batch runs pass archive=False and archive once at the end."""
+        if self.incremental:
+            return self.generate_csv_incremental(archive)
+        if self.streaming:
+            return self.generate_csv_streaming(archive)
+        raw_rows = lambda: self.raw_invoice.shape[0]
+        self.run_stage('remove_discount', self.remove_discount, raw_rows(), raw_rows)
+        self.run_stage('enrich_raw_invoice', self.enrich_raw_invoice, raw_rows(), raw_rows)
+        if self.report_missing_keys():
+            return False
+        writer = open_writer(os.path.join(self.save_location, self.create_output_name()), self.output_format, self.row_limit)
+        try:
+            self.schedule_sheets(writer).run()
+        except BaseException:
+            writer.discard()
+            raise
+        input_archive = InputArchive(self.current_location) if archive else None
+        try:
+            self.schedule_finish(writer, input_archive).run()
+        except BaseException:
+            if input_archive is not None:
+                input_archive.discard()
+            raise
+        if archive:
+            self.run_stage('archive_inputs', input_archive.commit)
+        return True
+
+    def schedule_finish(self, writer, input_archive=None):
+        """
+        StageScheduler for the file work left once every sheet is written: closing the output (xlsxwriter zips the workbook),
+        storing the month in the history database and, with input_archive (an InputArchive), copying Input into Archive.
+        None of them read what another writes, so they run side by side. The archive is only committed once all of them succeeded.
+        """
+        scheduler = StageScheduler()
+        scheduler.add('close_output', lambda: self.run_stage('close_output', writer.close))
+        scheduler.add('store_history', lambda: self.run_stage('store_history', lambda: store_history(self, [self.raw_invoice_path]), self.LensImport.shape[0] + self.count_report_sheet_rows()))
+        if input_archive is not None:
+            scheduler.add('stage_archive', lambda: self.run_stage('stage_archive', input_archive.stage, len(input_archive.names)))
+        return scheduler
+
+
+def generate_invoice_month(raw_invoice_path, reference, streaming=False, output_format='xlsx', current_path='', trace_memory=False, profile=None):
+    """
+    Batch worker: generates the workbook for one raw invoice. Invoice numbers come from the run folder's InvoiceSequence, which the workers share.
+    Returns (generated, run report stages) so the stages timed in this process end up in the run's report.
+    """
+    report = RunReport(trace_memory)
+    rg = ReportGenerator(streaming=streaming, raw_invoice_path=raw_invoice_path, reference=reference, output_format=output_format, current_path=current_path, report=report, profile=profile)
+    return rg.generate_csv(archive=False), report.stages
+
+def group_by_output(raw_invoices, profiles):
+    """raw_invoices grouped by the workbook they generate: {(supplier profile name, month): [raw invoice paths]}."""
+    groups = {}
+    for raw_invoice in raw_invoices:
+        groups.setdefault((find_profile(raw_invoice, profiles).name, invoice_month(raw_invoice)), []).append(raw_invoice)
+    return groups
+
+def generate_batch(_path, raw_invoices, streaming=False, max_workers=None, reference=None, output_format='xlsx', archive=True, report=None, profiles=None):
+    """
+    Generates a workbook for every raw invoice in raw_invoices, one month per process. Expects the Master Reference to be updated and checked already.
+    The raw invoices can be of several suppliers: each one is generated with the profile (of profiles, default: the run folder's) its name matches.
+    MasterReference is loaded once and handed to every worker. Input is archived once at the end, and only if every month succeeded.
+    Two raw invoices of the same supplier and month would write the same workbook and history month, so such a batch fails before anything is generated.
+    """
+    if reference is None:
+        reference = ReferenceContext(os.path.join(_path, 'MasterReference.xlsx'))
+    profiles = profiles if profiles is not None else load_profiles(_path)
+    report = report if report is not None else RunReport()
+    shared = [group for group in group_by_output(raw_invoices, profiles).values() if len(group) > 1]
+    if shared:
+        files = '; '.join(' and '.join(os.path.basename(raw_invoice) for raw_invoice in group) for group in shared)
+        error_popup(f'Failed to generate: {files} are for the same supplier and month, so they would write the same workbook. '
+                    'Run partial drops with --incremental, or leave one file per month in Input. Input was not archived.')
+        return False
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers or min(len(raw_invoices), os.cpu_count() or 1)) as pool:
+        futures = {pool.submit(generate_invoice_month, raw_invoice, reference, streaming, output_format, _path, report.trace_memory, find_profile(raw_invoice, profiles)): raw_invoice
+                   for raw_invoice in raw_invoices}
+        for future, raw_invoice in futures.items():
+            try:
+                generated, stages = future.result()
+                report.add_stages(stages)
+                if not generated:
+                    failed.append(os.path.basename(raw_invoice))
+            except Exception:
+                log.error(f'Failed to generate {os.path.basename(raw_invoice)}', exc_info=True)
+                failed.append(os.path.basename(raw_invoice))
+    if failed:
+        error_popup('Failed to generate: ' + ', '.join(failed) + '. Input was not archived.')
+        return False
+    if archive:
+        with report.stage('archive_inputs'):
+            archive_inputs(_path)
+    return True
+
+def main(_path = '', streaming=False, output_format='xlsx', month=None, archive=True, max_workers=None, report=None, incremental=False, upsert=False):
+    """
+    Full run: update the Master Reference, check it, then generate every raw invoice in Input. Returns one of the EXIT_ codes in ErrorLogging.
+    month (a date, any day) only generates the raw invoice(s) for that month, and only those are archived afterwards.
+    The raw invoices of every supplier in the run folder's SupplierProfiles.json are generated (default: just H00241's), each with its own profile.
+    incremental treats every raw invoice as a partial drop of its month (oldest first) and updates the month to date workbook.
+    upsert updates customers already in the Master Reference from the customer files instead of ignoring them (see MasterReferenceUpdater).
+    Every stage is timed into report (a RunReport), which is written to Output as RUN_REPORT.json/.csv however the run ends.
+    """
     if not _path:
         #_path = os.path.dirname(os.path.abspath(__file__)) #use this line for local development
         _path = os.path.dirname(sys.executable)
  # Currnet loc
-    def error_popup(msg):
-        """Super simple pop-up to indicate an error has occured."""
-        popup = tk.Tk()
-        popup.wm_title("!")
-        label = tk.Label(popup, text=msg)
-        label.pack(side="top", fill="x", pady=10)
-        B1 = tk.Button(popup, text="Okay", command = popup.destroy)
-        B1.pack()
-        popup.mainloop()
- 
-    #First, update the reference sheet
+    report = report if report is not None else RunReport()
+    try:
+        return run_stages(_path, streaming, output_format, month, archive, max_workers, report, incremental, upsert)
+    finally:
+        log.info('Run report written', extra={'fields': {'report': report.write(os.path.join(_path, 'Output'))}})
+
+def run_stages(_path, streaming, output_format, month, archive, max_workers, report, incremental=False, upsert=False):
+    """The steps of main, each timed as a stage of report."""
+    recovered = recover_archive(_path)
+    if recovered:
+        log.warning('Finished an interrupted archive', extra={'fields': {'runs': recovered}})
+    profiles = load_profiles(_path)
+    raw_invoices = find_raw_invoices(os.path.join(_path, 'Input'), profiles)
+    if month is not None:
+        raw_invoices = [raw_invoice for raw_invoice in raw_invoices if invoice_month(raw_invoice) == date(month.year, month.month, 1)]
+    with RunIO(_path) as run_io:
+        #The Master Reference is read once and shared by every step below. A single in memory invoice is read at the same time.
+        reference_future = run_io.prefetch_reference()
+        raw_invoice_future = run_io.prefetch_raw_invoice(raw_invoices[0]) if len(raw_invoices) == 1 and not (streaming or incremental) else None
+        with report.stage('load_reference') as record:
+            reference = reference_future.result()
+            record['rows_out'] = reference.customer_list.shape[0] + reference.price_reference.shape[0]
+        prefetched = {}
+        if raw_invoice_future is not None:
+            with report.stage('read_raw_invoice', invoice=os.path.basename(raw_invoices[0])) as record:
+                prefetched[raw_invoices[0]] = raw_invoice_future.result()
+                record['rows_out'] = prefetched[raw_invoices[0]].shape[0]
+
+    #First, update the reference sheet (in memory only, it's saved once the checks pass)
     #umr = UpdateMasterReference()
     #umr.add_new_customers_to_MasterReference()
-    umr = MasterReferenceUpdater(_path) 
-    umr.RUN()
-
-    #Next, run the sanity check
-    sc = SanityCheck()
-    passed_checks = sc.run_check()
-
-    #Finally generate the invoice plus summaries
-    if passed_checks:
-        rg = ReportGenerator()
-        if rg.invoice_Found:
-            rg.generate_csv()
-        else:
-            error_popup('Failed to run. No invoice found in input folder.')
-    else:
+    with report.stage('MasterReferenceUpdater.RUN', reference.customer_list.shape[0]) as record:
+        umr = MasterReferenceUpdater(_path, reference, upsert) 
+        umr.RUN()
+        record['rows_out'] = reference.customer_list.shape[0]
+
+    #Next, run the sanity check (including every Barcode of the invoices about to be generated)
+    with report.stage('SanityCheck.run_check', reference.customer_list.shape[0] + reference.price_reference.shape[0]) as record:
+        sc = SanityCheck(reference, _path)
+        passed_checks = sc.run_check(raw_invoices, prefetched)
+        record['rows_out'] = sc.LOG.shape[0]
+    if not passed_checks:
         error_popup('Failed to run. One or more tests failed. See REFERENCE_ERROR for details.')
-if __name__ == '__main__':
-    print('Running')
-    try:
-        main() #TODO remove
-    except:
-        print(traceback.format_exc())
-        with open(r'.\TRACEBACK.txt', 'w') as f:
-            f.write(f'{traceback.format_exc()}')
+        return EXIT_FAILED
+    with report.stage('save_reference', reference.customer_list.shape[0]):
+        saved = umr.save_reference()
+    if not saved:
+        error_popup(umr.FAILED)
+        return EXIT_FAILED
+    if not raw_invoices:
+        error_popup('Failed to run. No invoice found in input folder.')
+        return EXIT_NO_INVOICE
 
+    #A backlog of several months is generated in parallel, otherwise generate the invoice plus summaries
+    log.info(f'Generating {len(raw_invoices)} invoice(s)', extra={'fields': {'invoices': [os.path.basename(raw_invoice) for raw_invoice in raw_invoices]}})
+    with report.stage('generate', len(raw_invoices)):
+        if incremental:
+            #Drops of the same month build on each other, so they go one at a time in the order they arrived
+            generated = all(ReportGenerator(streaming=streaming, raw_invoice_path=raw_invoice, reference=reference, output_format=output_format, current_path=_path, report=report,
+                                            incremental=True, profile=find_profile(raw_invoice, profiles)).generate_csv(archive=False)
+                            for raw_invoice in sorted(raw_invoices, key=os.path.getmtime))
+            if generated and archive and month is None:
+                archive_inputs(_path)
+        elif len(raw_invoices) > 1:
+            generated = generate_batch(_path, raw_invoices, streaming, max_workers, reference, output_format, archive=archive and month is None, report=report, profiles=profiles)
+        else:
+            rg = ReportGenerator(streaming=streaming, raw_invoice_path=raw_invoices[0], reference=reference, output_format=output_format, current_path=_path, report=report,
+                                 profile=find_profile(raw_invoices[0], profiles), raw_invoice=prefetched.get(raw_invoices[0]))
+            generated = rg.generate_csv(archive=archive and month is None)
+    if not generated:
+        return EXIT_FAILED
+    if archive and month is not None:
+        with report.stage('archive_inputs', len(raw_invoices)):
+            archive_inputs(_path, raw_invoices)
+    log.info('Done')
+    return EXIT_OK
 
+if __name__ == '__main__':
+    freeze_support()
+    from InvoiceCLI import run
+    sys.exit(run())
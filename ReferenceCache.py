@@ -0,0 +1,103 @@
+import os
+import pickle
+import hashlib
+import pandas as pd
+from PricingRules import RULE_SHEETS
+
+REFERENCE_SHEETS = ['CustomerList', 'PriceSheet']
+#Sheets a Master Reference may have too
+OPTIONAL_SHEETS = list(RULE_SHEETS)
+_caches = {}
+
+def file_sha256(path):
+    """sha256 of a file's contents, read in 1 MiB blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_reference_cache(reference_path):
+    """Returns the shared cache for a Master Reference so every class in this process reuses the same parsed sheets."""
+    key = os.path.abspath(reference_path)
+    if key not in _caches:
+        _caches[key] = ReferenceCache(key)
+    return _caches[key]
+
+
+class ReferenceCache:
+    def __init__(self, reference_path):
+        """
+        Pickled snapshot of the Master Reference sheets, stored next to the workbook.
+        openpyxl parsing is the slowest part of start up, so the workbook is only parsed again when its mtime/size change
+        and its contents (sha256) actually differ from what the snapshot was built from.
+        """
+        self.reference_path = reference_path
+        self.cache_path = os.path.join(os.path.dirname(reference_path), '.' + os.path.basename(reference_path) + '.cache')
+        self.sheets = None
+        self.stat_key = None
+        self.content_hash = None
+
+    def get_stat_key(self):
+        stat = os.stat(self.reference_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get_content_hash(self):
+        return file_sha256(self.reference_path)
+
+    def read_snapshot(self):
+        """Loads the pickled snapshot, or None if there isn't a usable one."""
+        try:
+            with open(self.cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def write_snapshot(self):
+        """Saves the snapshot. A read only folder just means the next run parses the workbook again."""
+        snapshot = {'stat_key': self.stat_key, 'content_hash': self.content_hash, 'sheets': self.sheets}
+        try:
+            with open(self.cache_path, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+
+    def load(self):
+        """Returns {sheet name: DataFrame} for the current workbook, parsing it only if it changed."""
+        stat_key = self.get_stat_key()
+        if self.sheets is not None and stat_key == self.stat_key:
+            return self.sheets
+        snapshot = self.read_snapshot()
+        if snapshot is not None and snapshot['stat_key'] == stat_key:
+            self.sheets, self.stat_key, self.content_hash = snapshot['sheets'], stat_key, snapshot['content_hash']
+            return self.sheets
+        content_hash = self.get_content_hash()
+        if snapshot is not None and snapshot['content_hash'] == content_hash:
+            self.sheets = snapshot['sheets']
+        elif self.sheets is None or content_hash != self.content_hash:
+            self.sheets = self.read_workbook()
+        self.stat_key, self.content_hash = stat_key, content_hash
+        self.write_snapshot()
+        return self.sheets
+
+    def read_workbook(self):
+        """Parses the REFERENCE_SHEETS and whichever OPTIONAL_SHEETS the workbook has."""
+        with pd.ExcelFile(self.reference_path, engine='openpyxl') as workbook:
+            missing = [sheet_name for sheet_name in REFERENCE_SHEETS if sheet_name not in workbook.sheet_names]
+            if missing:
+                raise ValueError(f'Worksheet(s) {", ".join(missing)} not found in {self.reference_path}')
+            optional = [sheet_name for sheet_name in OPTIONAL_SHEETS if sheet_name in workbook.sheet_names]
+            return pd.read_excel(workbook, sheet_name=REFERENCE_SHEETS + optional)
+
+    def get(self, sheet_name):
+        return self.load()[sheet_name].copy()
+
+    def has(self, sheet_name):
+        return sheet_name in self.load()
+
+    def store(self, sheets):
+        """Records sheets that were just written to the workbook so the next load doesn't parse them back."""
+        self.sheets = {sheet_name: sheet.copy() for sheet_name, sheet in sheets.items()}
+        self.stat_key = self.get_stat_key()
+        self.content_hash = self.get_content_hash()
+        self.write_snapshot()
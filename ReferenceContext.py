@@ -0,0 +1,70 @@
+import pandas as pd
+from ReferenceCache import get_reference_cache
+from ReferenceIndex import ReferenceIndex
+from PricingRules import PricingRules, RULE_SHEETS
+from InvoiceSchema import apply_dtypes, PRICE_SHEET_DTYPES
+
+class ReferenceContext:
+    def __init__(self, reference_path):
+        """
+        The Master Reference for one run: the CustomerList and PriceSheet frames plus, per supplier, its customers and SuffixNum/UPC lookup index.
+        The optional PriceRules and DiscountRules sheets are kept as they are and compiled into PricingRules on first use.
+        MasterReferenceUpdater changes it in place, SanityCheck and ReportGenerator read it directly,
+        and save() writes it back once, after the run has validated.
+        """
+        self.reference_path = reference_path
+        self.cache = get_reference_cache(reference_path)
+        self.customer_list = self.cache.get('CustomerList')
+        self.price_reference = apply_dtypes(self.cache.get('PriceSheet'), PRICE_SHEET_DTYPES)
+        self.rule_sheets = {sheet_name: self.cache.get(sheet_name) for sheet_name in RULE_SHEETS if self.cache.has(sheet_name)}
+        self.rules = None
+        self.changed = False
+        self.customers = {} #supplier profile name: its customers with their SuffixNum
+        self.indexes = {} #supplier profile name: its ReferenceIndex
+        self.stat_key = self.cache.stat_key
+
+    def is_stale(self):
+        """True if the workbook on disk changed (or went missing) since this context was loaded or saved, e.g. someone edited it by hand."""
+        try:
+            return self.cache.get_stat_key() != self.stat_key
+        except FileNotFoundError:
+            return True
+
+    def set_customer_list(self, customer_list):
+        """Replaces the CustomerList. The change is only written to disk by save(). The suppliers' customers and indexes are rebuilt on next use."""
+        self.customer_list = customer_list
+        self.changed = True
+        self.customers = {}
+        self.indexes = {}
+
+    def get_customers(self, profile):
+        """The CustomerList rows of a supplier (a SupplierProfile) with their SuffixNum, built on first use."""
+        if profile.name not in self.customers:
+            self.customers[profile.name] = profile.select_customers(self.customer_list)
+        return self.customers[profile.name]
+
+    def get_index(self, profile):
+        """Lookup index over a supplier's SuffixNum and the UPC, built on first use."""
+        if profile.name not in self.indexes:
+            self.indexes[profile.name] = ReferenceIndex(self.get_customers(profile), self.price_reference)
+        return self.indexes[profile.name]
+
+    def get_rules(self):
+        """The compiled PricingRules, built on first use."""
+        if self.rules is None:
+            self.rules = PricingRules(self.rule_sheets)
+        return self.rules
+
+    def save(self):
+        """Writes the Master Reference if it changed during this run."""
+        if not self.changed:
+            return False
+        sheets = {'CustomerList': self.customer_list, 'PriceSheet': self.price_reference, **self.rule_sheets}
+        writer = pd.ExcelWriter(self.reference_path, engine='xlsxwriter')
+        for sheet_name, sheet in sheets.items():
+            sheet.to_excel(writer, index=False, sheet_name=sheet_name)
+        writer.close()
+        self.cache.store(sheets)
+        self.stat_key = self.cache.stat_key
+        self.changed = False
+        return True
@@ -0,0 +1,68 @@
+import copy
+import pandas as pd
+from InvoiceSchema import customer_keys
+
+class ReferenceIndex:
+    def __init__(self, customer_list, price_reference):
+        """
+        Hash indexes over the Master Reference so lookups are joins instead of full scans.
+        Customers are keyed on SuffixNum (see SupplierProfile.select_customers, an InvoiceSchema customer key), prices on UPC.
+        Like the old .iloc[0] lookups, the first row wins when a key is duplicated.
+        Keys that can't be found are collected so they can be reported in one go.
+        """
+        customer_list = customer_list[customer_list['SuffixNum'].notna()]
+        self.customers = customer_list.drop_duplicates(subset='SuffixNum', keep='first').set_index('SuffixNum')
+        prices = price_reference.copy()
+        prices['UPC'] = pd.to_numeric(prices['UPC'], errors='coerce')
+        prices = prices[prices['UPC'].notna()]
+        prices['UPC'] = prices['UPC'].astype('int64')
+        self.prices = prices.drop_duplicates(subset='UPC', keep='first').set_index('UPC')
+        self.missing_customers = set()
+        self.missing_upcs = set()
+
+    def for_run(self):
+        """Shallow copy that shares the indexes but collects its own missing keys, so a shared index can serve several runs."""
+        run = copy.copy(self)
+        run.missing_customers = set()
+        run.missing_upcs = set()
+        return run
+
+    @staticmethod
+    def customer_keys(dropship_nos):
+        """Converts DropShipNo values (int, float or str) to customer keys, the SuffixNum type."""
+        return customer_keys(dropship_nos)
+
+    @staticmethod
+    def upc_keys(barcodes):
+        """Converts Barcode values to the integer UPC format used in the PriceSheet."""
+        nums = pd.to_numeric(pd.Series(barcodes), errors='coerce')
+        return nums.dropna().astype('int64').reindex(nums.index)
+
+    def lookup_customers(self, dropship_nos, columns):
+        """Returns the CustomerList columns for every DropShipNo, aligned to the input index."""
+        keys = self.customer_keys(dropship_nos)
+        result = self.customers.reindex(keys)[columns]
+        result.index = keys.index
+        found = self.customers.index.get_indexer(keys) != -1
+        self.missing_customers.update(int(k) for k in keys[~found & keys.notna()])
+        return result
+
+    def lookup_prices(self, barcodes, columns):
+        """Returns the PriceSheet columns for every Barcode, aligned to the input index."""
+        keys = self.upc_keys(barcodes)
+        result = self.prices.reindex(keys)[columns]
+        result.index = keys.index
+        found = self.prices.index.get_indexer(keys) != -1
+        self.missing_upcs.update(int(k) for k in keys[~found & keys.notna()])
+        return result
+
+    def missing_report(self):
+        """Lists every missing key as (Description, Location) rows for the error log."""
+        findings = []
+        if self.missing_customers:
+            missing = ', '.join(str(customer) for customer in sorted(self.missing_customers))
+            findings.append((f'Customer numbers (DropShipNo) not found in Customer list: {missing}', 'MasterReference, Customer List'))
+        if self.missing_upcs:
+            missing = ', '.join(str(upc) for upc in sorted(self.missing_upcs))
+            findings.append((f'Barcodes not found in Price Sheet: {missing}', 'MasterReference, PriceSheet'))
+        return findings
@@ -0,0 +1,185 @@
+import os
+import shutil
+import filecmp
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from PathManager import locationManager as lm
+from ReferenceContext import ReferenceContext
+from InvoiceSchema import raw_invoice_dtypes
+
+#Each archive is a subfolder of Archive named after when it was made. It's built under STAGING_SUFFIX, renamed to
+#COMMITTED_SUFFIX once every copy is on disk, and only gets its plain name after the originals are gone from Input.
+#Both in between names start with '.', so nothing reading Archive sees a run until it's complete.
+STAGING_SUFFIX = '.tmp'
+COMMITTED_SUFFIX = '.moving'
+RUN_FOLDER_FORMAT = '%Y-%m-%d %H%M%S %f'
+#The Master Reference and the raw invoice, read side by side
+IO_THREADS = 2
+_run_folder_lock = threading.Lock()
+
+def read_raw_invoice(raw_invoice_path):
+    """A whole raw invoice with the RAW_INVOICE_DTYPES of InvoiceSchema."""
+    return pd.read_csv(raw_invoice_path, dtype=raw_invoice_dtypes(raw_invoice_path))
+
+def fsync_file(path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+def fsync_folder(path):
+    """Makes the files created, renamed or removed in a folder durable. Windows can't open folders (and NTFS journals renames itself)."""
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def archived_files(archive_path):
+    """
+    Every file in Archive, with the newest copy of a name winning (a file archived again after a rerun).
+    Archives made before the run subfolders sit directly in Archive and count as older than any run. Unfinished runs are skipped.
+    """
+    newest = {}
+    if not os.path.isdir(archive_path):
+        return []
+    entries = sorted((entry for entry in os.scandir(archive_path) if not entry.name.startswith('.')), key=lambda entry: (entry.is_dir(), entry.name))
+    for entry in entries:
+        files = [run_file for run_file in os.scandir(entry.path) if run_file.is_file()] if entry.is_dir() else [entry]
+        for archived in files:
+            newest[archived.name] = archived.path
+    return list(newest.values())
+
+def recover_archive(current_path=''):
+    """
+    Finishes or undoes an archive a crash interrupted, so Input is never left half moved. Call before listing Input, while no other run uses the folder.
+    A run still staging is removed (Input still has every file). A committed run has all its copies on disk, so the
+    originals left in Input (same contents) are removed and the run gets its plain name. Returns the runs it touched.
+    """
+    location = lm(current_path)
+    archive_path = location.get_archive_path()
+    if not os.path.isdir(archive_path):
+        return []
+    recovered = []
+    for name in sorted(os.listdir(archive_path)):
+        path = os.path.join(archive_path, name)
+        if not (name.startswith('.') and os.path.isdir(path)):
+            continue
+        if name.endswith(STAGING_SUFFIX):
+            shutil.rmtree(path)
+        elif name.endswith(COMMITTED_SUFFIX):
+            remove_originals(location.get_input_path(), path, os.listdir(path))
+            os.rename(path, os.path.join(archive_path, name[1:-len(COMMITTED_SUFFIX)]))
+        else:
+            continue
+        recovered.append(name)
+    if recovered:
+        fsync_folder(archive_path)
+    return recovered
+
+def remove_originals(input_path, run_path, names):
+    """Removes the Input files of names whose copy in run_path has the same contents."""
+    for name in names:
+        original = os.path.join(input_path, name)
+        if os.path.isfile(original) and filecmp.cmp(original, os.path.join(run_path, name), shallow=False):
+            os.remove(original)
+    fsync_folder(input_path)
+
+def archive_inputs(current_location, input_files=None):
+    """Moves the files in Input to a new run subfolder of Archive, atomically (see InputArchive). input_files limits it to those files (names or paths)."""
+    archive = InputArchive(current_location, input_files)
+    archive.stage()
+    return archive.commit()
+
+
+class InputArchive:
+    def __init__(self, current_path='', input_files=None):
+        """
+        Moves Input files (default: all of them, input_files limits it to those names or paths) into their own subfolder of Archive, all or nothing.
+        stage() copies them into a hidden folder and syncs every copy to disk, so it can run while the output is still being written.
+        commit() then renames the folder into place and only afterwards removes the originals; discard() drops the copies instead.
+        A crash at any point leaves either Input untouched or a committed run that recover_archive() finishes.
+        """
+        self.lm = lm(current_path)
+        self.input_path = self.lm.get_input_path()
+        self.archive_path = self.lm.get_archive_path()
+        names = os.listdir(self.input_path) if input_files is None else [os.path.basename(input_file) for input_file in input_files]
+        self.names = [name for name in names if os.path.isfile(os.path.join(self.input_path, name))]
+        self.run_name = None
+        self.staging_path = None
+
+    def make_staging_folder(self):
+        """Creates the hidden folder of a run named after now. Two archives made the same microsecond get a number added."""
+        os.makedirs(self.archive_path, exist_ok=True)
+        run_name = datetime.now().strftime(RUN_FOLDER_FORMAT)
+        with _run_folder_lock:
+            for attempt in range(1000):
+                name = run_name if attempt == 0 else f'{run_name} {attempt}'
+                if not any(os.path.exists(os.path.join(self.archive_path, candidate)) for candidate in [name, f'.{name}{STAGING_SUFFIX}', f'.{name}{COMMITTED_SUFFIX}']):
+                    os.mkdir(os.path.join(self.archive_path, f'.{name}{STAGING_SUFFIX}'))
+                    return name
+        raise FileExistsError(f'No free run folder name for {run_name} in {self.archive_path}')
+
+    def stage(self):
+        """Copies the files into the run's hidden staging folder and syncs them to disk. Input isn't touched."""
+        if not self.names:
+            return
+        self.run_name = self.make_staging_folder()
+        self.staging_path = os.path.join(self.archive_path, f'.{self.run_name}{STAGING_SUFFIX}')
+        for name in self.names:
+            copy = os.path.join(self.staging_path, name)
+            shutil.copy2(os.path.join(self.input_path, name), copy)
+            fsync_file(copy)
+        fsync_folder(self.staging_path)
+
+    def commit(self):
+        """Puts the staged run in place and removes the originals from Input. Returns the run folder (None if there was nothing to archive)."""
+        if self.staging_path is None:
+            return None
+        committed_path = os.path.join(self.archive_path, f'.{self.run_name}{COMMITTED_SUFFIX}')
+        run_path = os.path.join(self.archive_path, self.run_name)
+        os.rename(self.staging_path, committed_path)
+        fsync_folder(self.archive_path)
+        for name in self.names:
+            os.remove(os.path.join(self.input_path, name))
+        fsync_folder(self.input_path)
+        os.rename(committed_path, run_path)
+        fsync_folder(self.archive_path)
+        self.staging_path = None
+        return run_path
+
+    def discard(self):
+        """Drops the staged copies, for runs that failed after stage()."""
+        if self.staging_path is not None:
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+            self.staging_path = None
+
+
+class RunIO:
+    def __init__(self, current_path=''):
+        """
+        The file reads of a run that don't depend on each other, started together on a small thread pool at startup.
+        The Master Reference is mostly openpyxl (or the reference cache) and the raw invoice pandas' C csv parser, which releases the GIL,
+        so the two reads overlap instead of running back to back. Use as a context manager, or close() to wait for anything still running.
+        """
+        self.lm = lm(current_path)
+        self.pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='run-io')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def prefetch_reference(self):
+        """Future of the run's ReferenceContext."""
+        return self.pool.submit(ReferenceContext, self.lm.get_reference_path())
+
+    def prefetch_raw_invoice(self, raw_invoice_path):
+        """Future of a whole raw invoice, read like ReportGenerator reads it."""
+        return self.pool.submit(read_raw_invoice, raw_invoice_path)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
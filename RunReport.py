@@ -0,0 +1,86 @@
+import os
+import sys
+import csv
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPORT_COLUMNS = ['stage', 'invoice', 'seconds', 'rows_in', 'rows_out', 'peak_rss_mb', 'peak_traced_mb']
+
+def peak_rss_mb():
+    """High-water mark of this process's resident memory so far. None on Windows, which has no resource module."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+
+class RunReport:
+    def __init__(self, trace_memory=False):
+        """
+        Wall time, rows in/out and memory for each stage of a run, written as RUN_REPORT.json/.csv in Output.
+        peak_rss_mb is the process high-water mark at the end of the stage, so it only grows; the stage that raised it is the one to look at.
+        trace_memory=True also records each stage's own Python heap peak with tracemalloc (peak_traced_mb). It is accurate per stage
+        but slows the run down, so it's off by default.
+        """
+        self.trace_memory = trace_memory
+        self.stages = []
+        #traced peak so far of every stage still running (nested, or in other threads), so none of them lose it when a new stage resets the peak
+        self.open_peaks = {}
+        self.lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, rows_in=None, invoice=''):
+        """
+        Times the with block as one stage. Set record['rows_out'] inside the block to record the output size.
+        Stages can be nested (e.g. the generator stages inside main's 'generate'); each one is recorded in the order it finished.
+        Stages can also run at the same time in different threads (StageScheduler). The Python heap is shared, so the traced peak of
+        overlapping stages includes what the others allocated meanwhile.
+        """
+        record = {'stage': name, 'invoice': invoice, 'seconds': None, 'rows_in': rows_in, 'rows_out': None, 'peak_rss_mb': None, 'peak_traced_mb': None}
+        if self.trace_memory:
+            with self.lock:
+                self.update_open_peaks()
+                tracemalloc.reset_peak()
+                self.open_peaks[id(record)] = 0
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['peak_rss_mb'] = peak_rss_mb()
+            if self.trace_memory:
+                with self.lock:
+                    self.update_open_peaks()
+                    record['peak_traced_mb'] = round(self.open_peaks.pop(id(record)) / 2**20, 1)
+            self.stages.append(record)
+
+    def update_open_peaks(self):
+        """Folds the traced peak since the last reset into every running stage's peak."""
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self.open_peaks:
+            self.open_peaks[stage] = max(self.open_peaks[stage], peak)
+
+    def add_stages(self, stages):
+        """Adds stages recorded somewhere else, e.g. by a batch worker process."""
+        self.stages.extend(stages)
+
+    def write(self, folder, name='RUN_REPORT'):
+        """Writes <name>.json and <name>.csv to folder. Returns the json path."""
+        os.makedirs(folder, exist_ok=True)
+        json_path = os.path.join(folder, f'{name}.json')
+        with open(json_path, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=2)
+        with open(os.path.join(folder, f'{name}.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.stages)
+        return json_path
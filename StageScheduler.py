@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class StageScheduler:
+    def __init__(self, max_workers=None):
+        """
+        Runs steps on a thread pool, each one as soon as the steps it comes after are done, so independent steps run side by side.
+        Threads rather than processes: the steps share the ReportGenerator's frames, and pandas and the file writes release the GIL for much of their work.
+        If a step raises, nothing new is started, the running steps are waited for, and run() raises the first error.
+        """
+        self.max_workers = max_workers
+        self.steps = {}
+
+    def add(self, name, step, after=()):
+        """Adds step() under name. after names steps added earlier, so the order steps are added in is always a valid order to run them in."""
+        unknown = [dependency for dependency in after if dependency not in self.steps]
+        if unknown:
+            raise ValueError(f'{name} comes after unknown step(s) {", ".join(unknown)}')
+        if name in self.steps:
+            raise ValueError(f'Step {name} was already added')
+        self.steps[name] = (step, list(after))
+
+    def run(self):
+        """Runs every step. Returns {name: what the step returned}."""
+        results = {}
+        waiting = dict(self.steps)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while waiting or running:
+                if error is None:
+                    for name, (step, after) in list(waiting.items()):
+                        if all(dependency in results for dependency in after):
+                            running[pool.submit(step)] = name
+                            del waiting[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        results[name] = future.result()
+        if error is not None:
+            raise error
+        return results
@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import subprocess
+
+#Cold start targets in seconds (best of the runs, fresh interpreter each time).
+#--help must not load pandas at all; the full import is what every real run pays before doing any work.
+STARTUP_TARGETS = {
+    'cli --help': 0.3,
+    'import generator': 1.0,
+}
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMMANDS = {
+    'cli --help': [sys.executable, os.path.join(HERE, 'InvoiceCLI.py'), '--help'],
+    'import generator': [sys.executable, '-c', 'import QB_Invoice_Import_Generator'],
+}
+
+def time_command(command, runs):
+    """Best wall time of runs fresh processes."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main(runs=5):
+    """Prints the cold start time of each command against its target. Returns 1 if any target is missed."""
+    missed = False
+    print(f'{"command":>18} {"seconds":>9} {"target":>8}')
+    for name, command in COMMANDS.items():
+        seconds = time_command(command, runs)
+        missed = missed or seconds > STARTUP_TARGETS[name]
+        print(f'{name:>18} {seconds:>9.3f} {STARTUP_TARGETS[name]:>8.1f}{"  MISSED" if seconds > STARTUP_TARGETS[name] else ""}')
+    return 1 if missed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5))
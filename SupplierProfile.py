@@ -0,0 +1,86 @@
+import os
+import re
+import json
+from InvoiceSchema import customer_keys
+from InvoiceHistory import HISTORY_DB
+
+#Optional, next to the program: a JSON list of profiles, each an object of SupplierProfile arguments. Without it every run is for DEFAULT_PROFILE.
+SUPPLIER_PROFILES = 'SupplierProfiles.json'
+#Profile settings that name a file or pick out files, so no two profiles may share them
+UNIQUE_SETTINGS = ['name', 'raw_invoice_pattern', 'output_name', 'history_db']
+_profiles = {}
+
+class SupplierProfile:
+    def __init__(self, name, raw_invoice_pattern=None, account_prefix='', suffix_length=5, discount_column='Stock Lens 5% Discount',
+                 discount_rate=0.05, discount_description='5% Legacy Discount', terms='Net 15', row_limit=5000,
+                 output_name='Invoice Import 1', history_db=HISTORY_DB):
+        """
+        Everything that differs between the supplier accounts this program is run for.
+        raw_invoice_pattern (a regex, default the name) picks the supplier's raw invoices out of Input and Archive.
+        The supplier's customers are the CustomerList rows whose PLN Stock Lens Account Number starts with account_prefix ('' for all of them).
+        Their DropShipNo is the last suffix_length characters of that number without the '-' (H00241-00252 -> 252).
+        Customers with 'Yes' in discount_column get discount_rate off, invoiced as discount_description. terms is the Due Date of every
+        import row, row_limit the most rows QuickBooks takes per import sheet. The workbook is '<output_name> (Mmm YYYY).xlsx' and the
+        months are kept in the history database history_db. The incremental state of a month is named after the profile.
+        """
+        self.name = name
+        self.raw_invoice_pattern = raw_invoice_pattern or name
+        self.raw_invoice_regex = re.compile(self.raw_invoice_pattern)
+        self.account_prefix = account_prefix
+        self.suffix_length = suffix_length
+        self.discount_column = discount_column
+        self.discount_rate = discount_rate
+        self.discount_description = discount_description
+        self.terms = terms
+        self.row_limit = row_limit
+        self.output_name = output_name
+        self.history_db = history_db
+
+    def __repr__(self):
+        return f'SupplierProfile({self.name!r})'
+
+    def matches(self, file_name):
+        """True if file_name is one of this supplier's raw invoices."""
+        return bool(self.raw_invoice_regex.search(os.path.basename(file_name)))
+
+    def discount_label(self):
+        """The discount as the Summary Overview shows it, e.g. 'Retail 5% Discount'."""
+        return f'Retail {self.discount_rate*100:g}% Discount'
+
+    def select_customers(self, customer_list):
+        """This supplier's CustomerList rows with their customer key (SuffixNum) added."""
+        accounts = customer_list['PLN Stock Lens Account Number']
+        if self.account_prefix:
+            customer_list = customer_list[accounts.str.startswith(self.account_prefix, na=False).values]
+            accounts = customer_list['PLN Stock Lens Account Number']
+        suffix_nums = customer_keys(accounts.str[-self.suffix_length:].str.replace('-', '', regex=False)).values
+        return customer_list.assign(SuffixNum=suffix_nums)
+
+DEFAULT_PROFILE = SupplierProfile('H00241')
+
+def read_profiles(path):
+    """The profiles in a SUPPLIER_PROFILES file. Settings a profile leaves out are DEFAULT_PROFILE's (raw_invoice_pattern: its name)."""
+    with open(path) as f:
+        profiles = [SupplierProfile(**settings) for settings in json.load(f)]
+    if not profiles:
+        raise ValueError(f'{path} has no supplier profiles')
+    for setting in UNIQUE_SETTINGS:
+        values = [getattr(profile, setting) for profile in profiles]
+        shared = sorted({value for value in values if values.count(value) > 1})
+        if shared:
+            raise ValueError(f'Supplier profiles in {path} must each have their own {setting}, shared: {", ".join(map(str, shared))}')
+    return profiles
+
+def load_profiles(current_path):
+    """The supplier profiles of a run folder, read once per process: its SUPPLIER_PROFILES file, or just DEFAULT_PROFILE."""
+    path = os.path.abspath(os.path.join(current_path, SUPPLIER_PROFILES))
+    if path not in _profiles:
+        _profiles[path] = read_profiles(path) if os.path.exists(path) else [DEFAULT_PROFILE]
+    return _profiles[path]
+
+def find_profile(raw_invoice_path, profiles):
+    """The profile whose raw invoices raw_invoice_path is one of. A file none of them match is treated as DEFAULT_PROFILE's."""
+    for profile in profiles:
+        if profile.matches(raw_invoice_path):
+            return profile
+    return DEFAULT_PROFILE
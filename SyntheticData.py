@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pandas as pd
+from datetime import date
+from calendar import month_name, monthrange
+
+#Shares of the raw invoice rows, roughly what a real month looks like
+RETURN_SHARE = 0.2
+FREIGHT_SHARE = 0.5
+TAX_SHARE = 0.1
+DISCOUNT_ROWS = 1
+
+def make_customer_list(customers, first_record_id=1000, seed=0):
+    """CustomerList with customers rows. PLN numbers run H00241-00001, H00241-00002, ... so DropShipNo 1..customers are valid."""
+    rng = np.random.default_rng(seed)
+    numbers = np.arange(1, customers+1)
+    return pd.DataFrame({
+        'Record ID': first_record_id + numbers - 1,
+        'Customer Name': [f'Customer {i}' for i in numbers],
+        'PLN Stock Lens Account Number': [f'H00241-{i:05d}' for i in numbers],
+        'Pivotal Account No.': [f'{50000+i}A' for i in numbers],
+        'Stock Lens 5% Discount': rng.choice(['Yes', 'No'], customers),
+    })
+
+def make_price_sheet(upcs, seed=0):
+    """PriceSheet with upcs distinct 12 digit UPCs."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'UPC': rng.choice(9 * 10**11, upcs, replace=False) + 10**11,
+        'Lens': rng.choice(['Single Vision', 'Bifocal', 'Progressive'], upcs),
+        'Retail': rng.uniform(3, 90, upcs).round(2),
+    })
+
+def make_master_reference(path, customers, upcs, seed=0):
+    """Writes a MasterReference.xlsx with both sheets and returns (customer_list, price_sheet)."""
+    customer_list = make_customer_list(customers, seed=seed)
+    price_sheet = make_price_sheet(upcs, seed=seed)
+    writer = pd.ExcelWriter(path, engine='xlsxwriter')
+    customer_list.to_excel(writer, index=False, sheet_name='CustomerList')
+    price_sheet.to_excel(writer, index=False, sheet_name='PriceSheet')
+    writer.close()
+    return customer_list, price_sheet
+
+def make_raw_invoice(path, rows, customers, upcs, month=date(2023, 3, 1), seed=0):
+    """
+    Writes an H00241 raw invoice with rows item rows for DropShipNo 1..customers and Barcodes from upcs.
+    About RETURN_SHARE of the rows are returns (negative ShipQty), FREIGHT_SHARE carry freight and TAX_SHARE carry tax.
+    The Pivotal discount row(s) (DropShipNo 0) go at the end, like in the supplier's file.
+    """
+    rng = np.random.default_rng(seed)
+    unit_price = rng.uniform(1, 40, rows).round(2)
+    ship_qty = np.where(rng.random(rows) < RETURN_SHARE, -1, rng.integers(1, 4, rows))
+    raw = pd.DataFrame({
+        'PONo': [f'PO{i}' for i in range(rows)],
+        'OrderID': [f'S{100000 + i//3}' for i in range(rows)],
+        'ShipDate': [f'{month.month}/{day}/{month.year}' for day in rng.integers(1, monthrange(month.year, month.month)[1]+1, rows)],
+        'DropShipNo': rng.integers(1, customers+1, rows),
+        'ItemName': [f'Lens {i % 50}' for i in range(rows)],
+        'Barcode': rng.choice(np.asarray(upcs), rows),
+        'ShipQty': ship_qty,
+        'UnitPrice': unit_price,
+        'ShipAmount': (unit_price * ship_qty).round(2),
+        'ShipVia': rng.choice(['UPS', 'USPS', 'FedEx'], rows),
+        'Freight': np.where(rng.random(rows) < FREIGHT_SHARE, rng.choice([4.95, 7.5, 12.35], rows), 0),
+        'Tax': np.where(rng.random(rows) < TAX_SHARE, rng.uniform(0.1, 5, rows).round(2), 0),
+        'TotalAmount': 0.0,
+    })
+    discount = pd.DataFrame({'PONo': 'DISC', 'OrderID': 'S0', 'ShipDate': f'{month.month}/{monthrange(month.year, month.month)[1]}/{month.year}',
+                             'DropShipNo': 0, 'ItemName': 'Discount', 'Barcode': upcs[0], 'ShipQty': 0, 'UnitPrice': 0.0,
+                             'ShipAmount': 0.0, 'ShipVia': '', 'Freight': 0.0, 'Tax': 0.0, 'TotalAmount': -123.45}, index=range(DISCOUNT_ROWS))
+    pd.concat([raw, discount], ignore_index=True).to_csv(path, index=False)
+
+def make_customer_file(path, customer_list, new_customers, seed=0):
+    """Writes a customer export with every existing customer plus new_customers new ones, for MasterReferenceUpdater to merge."""
+    new = make_customer_list(customer_list.shape[0] + new_customers, seed=seed + 1)[customer_list.shape[0]:]
+    pd.concat([customer_list, new], ignore_index=True).to_csv(path, index=False)
+
+def make_dataset(folder, customers, upcs, rows, month=date(2023, 3, 1), new_customers=0, seed=0):
+    """
+    Lays out a complete run folder: MasterReference.xlsx, Input (raw invoice and, with new_customers, a customer file), Output and Archive.
+    new_customers are only in the customer file, so the raw invoice only uses customers that are in the Master Reference already.
+    Returns the raw invoice path.
+    """
+    for sub_folder in ['Input', 'Output', 'Archive']:
+        os.makedirs(os.path.join(folder, sub_folder), exist_ok=True)
+    customer_list, price_sheet = make_master_reference(os.path.join(folder, 'MasterReference.xlsx'), customers, upcs, seed)
+    raw_invoice_path = os.path.join(folder, 'Input', f'H00241 Invoice {month_name[month.month]} {month.year}.csv')
+    make_raw_invoice(raw_invoice_path, rows, customers, price_sheet['UPC'].tolist(), month, seed)
+    if new_customers:
+        make_customer_file(os.path.join(folder, 'Input', 'customers.csv'), customer_list, new_customers, seed)
+    return raw_invoice_path
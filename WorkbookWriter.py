@@ -0,0 +1,240 @@
+import os
+import pickle
+import shutil
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+HEADER_FORMAT = {'bold': True, 'align': 'center', 'valign': 'top', 'top': 1, 'right': 1, 'bottom': 1, 'left': 1}
+DATE_FORMAT = 'YYYY-MM-DD'
+DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+OUTPUT_FORMATS = ['xlsx', 'csv', 'both']
+#Extension of a workbook still being written
+PARTIAL_SUFFIX = '.partial'
+
+def open_writer(output_path, output_format='xlsx', row_limit=None):
+    """
+    Writer for one report. output_path is the .xlsx path; csv output goes into a folder of the same name without the extension.
+    output_format is one of OUTPUT_FORMATS, 'both' writes the workbook and the csv files side by side.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}')
+    writers = []
+    if output_format in ['xlsx', 'both']:
+        writers.append(WorkbookWriter(output_path))
+    if output_format in ['csv', 'both']:
+        writers.append(CsvWriter(os.path.splitext(output_path)[0], row_limit))
+    return writers[0] if len(writers) == 1 else WriterGroup(writers)
+
+
+class WorkbookWriter:
+    def __init__(self, path, constant_memory=True):
+        """
+        Writes DataFrames to an xlsx workbook row by row with xlsxwriter.
+        pandas' to_excel writes a sheet column by column, so xlsxwriter has to hold the whole workbook in memory until close.
+        Here each sheet is written in row order, which lets xlsxwriter's constant_memory mode flush every row to disk as it goes.
+        Cells come out the same as DataFrame.to_excel(index=False): bold bordered header, blank cells for NaN, dates as YYYY-MM-DD.
+        In constant_memory mode every sheet must be written in one go, before the next one is started.
+        The workbook is zipped up under a PARTIAL_SUFFIX name and only renamed to path once it's complete, so a run that
+        dies while closing never leaves a truncated workbook behind (or replaces last run's good one with it).
+        """
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.book = xlsxwriter.Workbook(self.partial_path, {'constant_memory': constant_memory})
+        self.header_format = self.book.add_format(HEADER_FORMAT)
+        self.date_format = self.book.add_format({'num_format': DATE_FORMAT})
+        self.datetime_format = self.book.add_format({'num_format': DATETIME_FORMAT})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def cell_value(value):
+        """Same conversion pandas applies before writing a cell. None means the cell is left blank."""
+        if value is None or value is pd.NA or value is pd.NaT:
+            return None
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        if isinstance(value, (int, np.integer)):
+            return int(value)
+        if isinstance(value, (float, np.floating)):
+            if np.isnan(value):
+                return None
+            if np.isinf(value):
+                return 'inf' if value > 0 else '-inf'
+            return float(value)
+        if isinstance(value, (datetime.date, str)):
+            return value
+        if isinstance(value, datetime.timedelta):
+            return value.total_seconds() / 86400
+        return str(value)
+
+    @classmethod
+    def column_values(cls, column):
+        """Converts a whole column to Python cell values, using tolist() for the plain numeric dtypes."""
+        kind = column.dtype.kind if isinstance(column.dtype, np.dtype) else 'O'
+        if kind in 'iub':
+            return column.tolist()
+        if kind == 'f':
+            return [cls.cell_value(value) for value in column.astype('float64').tolist()]
+        return [cls.cell_value(value) for value in column.astype(object).tolist()]
+
+    def get_format(self, value):
+        if isinstance(value, datetime.datetime):
+            return self.datetime_format
+        if isinstance(value, datetime.date):
+            return self.date_format
+        return None
+
+    def write_sheet(self, frame, sheet_name):
+        """Writes frame (without its index) to a new sheet called sheet_name."""
+        return self.write_sheet_chunks([frame], sheet_name, frame.shape[0])
+
+    def write_sheet_chunks(self, frames, sheet_name, rows):
+        """Writes frames (the same columns, e.g. a SheetSpool) one after the other to a new sheet, under the first one's header."""
+        worksheet = self.book.add_worksheet(sheet_name)
+        row = 0
+        for i, frame in enumerate(frames):
+            if i == 0:
+                for col, column_name in enumerate(frame.columns):
+                    worksheet.write(0, col, self.cell_value(column_name), self.header_format)
+            columns = [self.column_values(frame.iloc[:, col]) for col in range(frame.shape[1])]
+            may_be_dates = [frame.dtypes.iloc[col].kind in 'OMm' for col in range(frame.shape[1])]
+            for row, values in enumerate(zip(*columns), start=row+1):
+                for col, value in enumerate(values):
+                    if value is None or value == '':
+                        continue
+                    worksheet.write(row, col, value, self.get_format(value) if may_be_dates[col] else None)
+        return worksheet
+
+    def close(self):
+        try:
+            self.book.close()
+        except BaseException:
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+            raise
+        os.replace(self.partial_path, self.path)
+
+    def discard(self):
+        """Closes the workbook and deletes it, for runs that failed part way through."""
+        self.book.close()
+        os.remove(self.partial_path)
+
+
+class CsvWriter:
+    def __init__(self, folder, row_limit=None):
+        """
+        Writes every sheet to '<folder>/<sheet name>.csv', the format QuickBooks import tools take directly.
+        A sheet with more than row_limit rows is split into '<sheet name> 1.csv', '<sheet name> 2.csv', ... each with the header.
+        Like WorkbookWriter, the files go into a hidden PARTIAL_SUFFIX folder next to folder, which only replaces the last
+        run's folder on close(), so a run that fails part way leaves the last good export as it was.
+        """
+        self.path = folder
+        self.row_limit = row_limit
+        parent, name = os.path.split(folder)
+        self.folder = os.path.join(parent, f'.{name}{PARTIAL_SUFFIX}')
+        #Left over from a run that died while writing
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_sheet(self, frame, sheet_name):
+        self.write_sheet_chunks([frame], sheet_name, frame.shape[0])
+
+    def write_sheet_chunks(self, frames, sheet_name, rows):
+        """Writes frames (the same columns, e.g. a SheetSpool) one after the other as one sheet of rows rows, split like any other."""
+        limit = self.row_limit if self.row_limit and rows > self.row_limit else None
+        part, part_rows = 0, 0
+        for i, frame in enumerate(frames):
+            start = 0
+            #The first frame starts the first file even if it's empty, so an empty sheet still gets its header
+            while start < frame.shape[0] or (i == 0 and part == 0):
+                new_file = part == 0 or (limit is not None and part_rows == limit)
+                if new_file:
+                    part, part_rows = part + 1, 0
+                    path = os.path.join(self.folder, f'{sheet_name} {part}.csv' if limit else f'{sheet_name}.csv')
+                end = frame.shape[0] if limit is None else min(frame.shape[0], start + limit - part_rows)
+                frame[start:end].to_csv(path, index=False, header=new_file, mode='w' if new_file else 'a')
+                part_rows += end - start
+                start = end
+
+    def close(self):
+        """Swaps the finished folder in for the last run's (whose files, possibly split differently, are removed)."""
+        parent, name = os.path.split(self.path)
+        replaced = os.path.join(parent, f'.{name}.replaced')
+        shutil.rmtree(replaced, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.rename(self.path, replaced)
+        os.rename(self.folder, self.path)
+        shutil.rmtree(replaced, ignore_errors=True)
+
+    def discard(self):
+        """Deletes this run's files. The last run's folder isn't touched."""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class WriterGroup:
+    def __init__(self, writers):
+        """Sends every sheet to several writers, e.g. the workbook and its csv files."""
+        self.writers = writers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_sheet(self, frame, sheet_name):
+        for writer in self.writers:
+            writer.write_sheet(frame, sheet_name)
+
+    def write_sheet_chunks(self, frames, sheet_name, rows):
+        for writer in self.writers:
+            writer.write_sheet_chunks(frames, sheet_name, rows)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def discard(self):
+        for writer in self.writers:
+            writer.discard()
+
+
+class SheetSpool:
+    def __init__(self):
+        """
+        The rows of one sheet, appended chunk by chunk and pickled into an anonymous temporary file instead of kept in memory,
+        until the sheets before it are written. Iterating reads the chunks back one at a time (a spool can be read more than once).
+        """
+        self.file = tempfile.TemporaryFile()
+        self.rows = 0
+        self.chunks = 0
+
+    def append(self, frame):
+        """Adds a chunk's rows. Empty chunks are skipped once there is a chunk to take the columns from."""
+        if frame.empty and self.chunks:
+            return
+        self.file.seek(0, os.SEEK_END)
+        pickle.dump(frame, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.rows += frame.shape[0]
+        self.chunks += 1
+
+    def __iter__(self):
+        self.file.seek(0)
+        for _ in range(self.chunks):
+            yield pickle.load(self.file)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import json
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from WorkbookWriter import WorkbookWriter
+try:
+    import resource
+except ImportError:
+    resource = None
+
+QB_SHEET_ROW_LIMIT = 5000
+
+def peak_memory_mb():
+    """Peak resident memory of this process. Windows has no resource module, so the tracemalloc peak is used there instead."""
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def make_lens_import(rows):
+    """Synthetic sheet shaped like Lens Import: strings, bools, ints, floats and a few blanks."""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame()
+    df['Customer'] = [f'Customer {i % 300}' for i in range(rows)]
+    df['Invoice Date'] = ['03/31/2023'] * rows
+    df['Invoice No'] = [f'D{i % 900:04d}' for i in range(rows)]
+    df['Terms'] = ['Net 15'] * rows
+    df['To Be emailed'] = [False] * rows
+    df['Print Later'] = [False] * rows
+    df['DropShipNo'] = rng.integers(1, 300, rows)
+    df['Item'] = [f'SKU{i % 2000}' for i in range(rows)]
+    df['Barcode'] = rng.integers(10**11, 10**12, rows)
+    df['ShipAmount'] = rng.integers(1, 10, rows).astype('float32')
+    df['UnitPrice'] = rng.uniform(1, 100, rows).round(2)
+    df['NewUnit$'] = df['UnitPrice'] * 0.95
+    df['NewShipAmount'] = (df['ShipAmount'] * df['NewUnit$']).round(2)
+    df['Category'] = np.where(rng.random(rows) < 0.1, np.nan, 'Stock Lens')
+    return df
+
+def write_pandas(df, path):
+    writer = pd.ExcelWriter(path, engine='xlsxwriter')
+    for i in range(0, df.shape[0], QB_SHEET_ROW_LIMIT):
+        df[i:i+QB_SHEET_ROW_LIMIT].to_excel(writer, index=False, sheet_name=f'Lens Import {i//QB_SHEET_ROW_LIMIT+1}')
+    writer.close()
+
+def write_rows(df, path):
+    writer = WorkbookWriter(path)
+    for i in range(0, df.shape[0], QB_SHEET_ROW_LIMIT):
+        writer.write_sheet(df[i:i+QB_SHEET_ROW_LIMIT], f'Lens Import {i//QB_SHEET_ROW_LIMIT+1}')
+    writer.close()
+
+WRITERS = {'pandas': write_pandas, 'constant_memory': write_rows}
+
+def run_one(writer_name, rows):
+    """Times one writer in this process and prints {seconds, peak_mb} as JSON."""
+    if resource is None:
+        tracemalloc.start()
+    df = make_lens_import(rows)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'benchmark.xlsx')
+        start = time.perf_counter()
+        WRITERS[writer_name](df, path)
+        seconds = time.perf_counter() - start
+    print(json.dumps({'seconds': seconds, 'peak_mb': peak_memory_mb()}))
+
+def main(rows_list=(10000, 50000, 200000)):
+    """Runs every writer in its own process, so each peak memory figure only belongs to that writer."""
+    print(f'{"rows":>8} {"writer":>16} {"seconds":>9} {"peak MB":>9}')
+    for rows in rows_list:
+        for writer_name in WRITERS:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--one', writer_name, str(rows)], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f'{rows:>8} {writer_name:>16} {result["seconds"]:>9.2f} {result["peak_mb"]:>9.1f}')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--one':
+        run_one(sys.argv[2], int(sys.argv[3]))
+    else:
+        main([int(rows) for rows in sys.argv[1:]] or (10000, 50000, 200000))